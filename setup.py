@@ -11,13 +11,11 @@ setup(
     install_requires=[
         'colorlog',
         'Essentia',
-        'joblib',
         'librosa',
         'numpy',
         'pyAudio',
         'scikit-learn',
         'scipy',
-        'yodel',
     ],
     include_package_data=True,
 )
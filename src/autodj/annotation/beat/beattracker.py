@@ -1,6 +1,6 @@
 import numpy as np
-from essentia import *
-from essentia.standard import Windowing, OnsetDetection, FrameGenerator
+
+from ..onsetdetection import onset_detection_functions, ODF_METHODS
 
 
 class BeatTracker:
@@ -19,8 +19,7 @@ class BeatTracker:
         self.phase = None
         self.beats = None
         self.onset_curve = None
-        self.fft_mag_1024_512 = None
-        self.fft_phase_1024_512 = None
+        self.odfs_1024_512 = None
 
     def getBpm(self):
         """
@@ -54,25 +53,13 @@ class BeatTracker:
             raise Exception('No onset detection curve calculated yet, you must run the BeatTracker first!')
         return self.onset_curve
 
-    def run(self, audio):
-        pool = Pool()
-        w = Windowing(type='hann')
-        fft = np.fft.fft
-        od_flux = OnsetDetection(method='melflux')
-
-        for frame in FrameGenerator(audio, frameSize=self.FRAME_SIZE, hopSize=self.HOP_SIZE):
-            pool.add('audio.windowed_frames', w(frame))
-
-        fft_result = fft(pool['audio.windowed_frames']).astype('complex64')
-        fft_result_mag = np.absolute(fft_result)
-        fft_result_ang = np.angle(fft_result)
-        self.fft_mag_1024_512 = fft_result_mag
-        self.fft_phase_1024_512 = fft_result_ang
-
-        for mag, phase in zip(fft_result_mag, fft_result_ang):
-            pool.add('onsets.complex', od_flux(mag, phase))
-
-        odf = pool['onsets.complex']
+    def run(self, audio, methods=ODF_METHODS):
+        """
+        Analyses the audio. The onset detection functions of the given methods, which must include melflux, are
+        calculated in the same pass and kept in odfs_1024_512 for the annotation modules that use them.
+        """
+        self.odfs_1024_512 = onset_detection_functions(audio, methods, self.FRAME_SIZE, self.HOP_SIZE)
+        odf = self.odfs_1024_512['melflux']
 
         tempo, tempo_curve, phase, phase_curve = BeatTracker.get_tempo_and_phase_from_odf(odf, self.HOP_SIZE)
 
@@ -82,7 +69,7 @@ class BeatTracker:
         self.bpm = tempo
         self.phase = phase
         self.beats = beats
-        self.onset_curve = BeatTracker.hwr(pool['onsets.complex'])
+        self.onset_curve = BeatTracker.hwr(odf)
 
     @staticmethod
     def autocorr(x):
@@ -1,9 +1,9 @@
 import os
 
 import numpy as np
-from sklearn.externals import joblib
 
 from . import features
+from .. import npmodels
 from .features import loudness, mfcc, onsetflux, onsetcsd, onsethfc
 
 feature_modules = [features.loudness, features.mfcc, features.onsetflux, features.onsetcsd, features.onsethfc]
@@ -15,8 +15,8 @@ class DownbeatTracker:
     """
 
     def __init__(self):
-        self.model = joblib.load(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'model.pkl'))
-        self.scaler = joblib.load(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'scaler.pkl'))
+        self.model = npmodels.load_model(os.path.abspath(os.path.dirname(__file__)), 'model')
+        self.scaler = npmodels.load_model(os.path.abspath(os.path.dirname(__file__)), 'scaler')
 
     def trimAudio(self, audio, beats):
         beats = np.array(beats) * 44100  # Beats in samples
@@ -58,19 +58,41 @@ class DownbeatTracker:
                 features_cur_file = np.append(features_cur_file, absolute_feature_submatrix, axis=1)
         return features_cur_file, trim_start_beat
 
-    def track(self, audio, beats, fft_mag, fft_phase, onset_curve):
+    def features(self, audio, beats, odfs, onset_curve):
         """
-        Track the downbeats of the given audio file
+        Returns the feature matrix (one row per beat) of the given audio file and the first beat it starts at
         """
         input_features = {
             'audio': audio,
             'beats': beats,
-            'fft_mag': fft_mag,
-            'fft_ang': fft_phase,
+            'odfs': odfs,
             'onset_curve': onset_curve,
         }
-        features, trim_start_beat = self.getFeaturesForAudio(input_features)
-        probas = self.model.predict_log_proba(features)
+        return self.getFeaturesForAudio(input_features)
+
+    def track(self, audio, beats, odfs, onset_curve):
+        """
+        Track the downbeats of the given audio file, given its onset detection functions (see
+        annotation.onsetdetection)
+        """
+        return self.track_batch([(audio, beats, odfs, onset_curve)])[0]
+
+    def track_batch(self, songs):
+        """
+        Tracks the downbeats of several audio files, given as (audio, beats, odfs, onset_curve) tuples.
+        The features of all files are classified in one call.
+        """
+        song_features = [self.features(*song) for song in songs]
+        features = np.concatenate([f for f, _ in song_features])
+        probas = npmodels.logistic_predict_log_proba(features, self.model)
+        split_indices = np.cumsum([len(f) for f, _ in song_features])[:-1]
+        downbeats = []
+        for song_probas, (_, trim_start_beat), song in zip(np.split(probas, split_indices), song_features, songs):
+            beats = song[1]
+            downbeats.append(self.downbeats_from_log_probas(song_probas, trim_start_beat, beats))
+        return downbeats
+
+    def downbeats_from_log_probas(self, probas, trim_start_beat, beats):
         sum_log_probas = np.array([[0, 0, 0, 0]], dtype='float64')
         permuted_row = [0] * 4
         for i, j, row in zip(range(len(probas)), np.array(range(len(probas))) % 4, probas):
@@ -1,26 +1,17 @@
 import numpy as np
-from essentia import *
-from essentia.standard import OnsetDetection
 from sklearn import preprocessing
 
 
 def feature_allframes(input_features, frame_indexer=None):
     beats = input_features['beats']
-    fft_result_mag = input_features['fft_mag']
-    fft_result_ang = input_features['fft_ang']
-
-    odf = OnsetDetection(method='complex')
-    pool = Pool()
+    odf = input_features['odfs']['complex']
     HOP_SIZE = 512
 
-    for mag, phase in zip(fft_result_mag, fft_result_ang):
-        pool.add('onsets.flux', odf(mag, phase))
-
     def adaptive_mean(x, N):
         return np.convolve(x, [1.0] * int(N), mode='same') / N
 
-    novelty_mean = adaptive_mean(pool['onsets.flux'], 16)
-    novelty_hwr = (pool['onsets.flux'] - novelty_mean).clip(min=0)
+    novelty_mean = adaptive_mean(odf, 16)
+    novelty_hwr = (odf - novelty_mean).clip(min=0)
     novelty_hwr = novelty_hwr / np.average(novelty_hwr)
 
     if frame_indexer is None:
@@ -8,12 +8,12 @@ class KeyEstimator:
     def __init__(self):
         pass
 
-    def __call__(self, audio):
-        FRAME_SIZE = 2048
+    def __call__(self, audio, sample_rate=44100):
+        FRAME_SIZE = 2048 * sample_rate // 44100  # Same frequency resolution at every sample rate
         HOP_SIZE = FRAME_SIZE // 2
         spec = Spectrum(size=FRAME_SIZE)
-        specPeaks = SpectralPeaks()
-        hpcp = HPCP()
+        specPeaks = SpectralPeaks(sampleRate=sample_rate)
+        hpcp = HPCP(sampleRate=sample_rate)
         key = Key(profileType='edma')
         w = Windowing(type='blackmanharris92')
         pool = Pool()
@@ -0,0 +1,81 @@
+"""
+Inference for the bundled scikit-learn models with plain NumPy.
+
+The models are stored as one .npy file per fitted attribute, named <model>.<attribute>.npy (for instance
+scaler.mean_.npy), as exported by tools/ToolExportModels.py from the original pickles. The files are memory mapped
+read-only, so worker processes share a single copy of the coefficients. The kernels below compute the same
+operations as the corresponding scikit-learn methods, in the same order and precision.
+"""
+import glob
+import os
+
+import numpy as np
+
+
+def load_model(directory, name):
+    """
+    Returns a dict with the fitted attributes of the exported model name in directory.
+    """
+    prefix = os.path.join(directory, name + '.')
+    paths = glob.glob(glob.escape(prefix) + '*.npy')
+    if not paths:
+        raise FileNotFoundError('No coefficients found for model {} in {}, export them with '
+                                'python3 -m autodj.tools.ToolExportModels'.format(name, directory))
+    return {path[len(prefix):-len('.npy')]: np.load(path, mmap_mode='r') for path in paths}
+
+
+def standard_scale(X, scaler):
+    """
+    StandardScaler.transform
+    """
+    X = np.array(X, dtype=X.dtype if X.dtype in (np.float32, np.float64) else np.float64)
+    X -= scaler['mean_']
+    X /= scaler['scale_']
+    return X
+
+
+def pca_transform(X, pca):
+    """
+    PCA.transform, without whitening
+    """
+    return np.dot(X - pca['mean_'], pca['components_'].T)
+
+
+def logistic_predict_log_proba(X, model):
+    """
+    LogisticRegression.predict_log_proba for a one-vs-rest model with more than two classes
+    """
+    prob = np.dot(X, model['coef_'].T) + model['intercept_']
+    prob *= -1
+    np.exp(prob, prob)
+    prob += 1
+    np.reciprocal(prob, prob)
+    prob /= prob.sum(axis=1).reshape((prob.shape[0], -1))
+    return np.log(prob)
+
+
+def svm_decision_function(X, model):
+    """
+    decision_function of a linear classifier (coef_ and intercept_) or of a binary SVC with a linear or an RBF kernel
+    (kernel, classes_, support_vectors_, dual_coef_, intercept_ and _gamma)
+    """
+    if 'kernel' not in model and 'coef_' in model:
+        decision = np.dot(X, model['coef_'].T) + model['intercept_']
+    else:
+        if 'kernel' not in model:
+            raise ValueError('The SVM kernel was not exported, export the model again with '
+                             'python3 -m autodj.tools.ToolExportModels')
+        kernel = str(model['kernel'])
+        if kernel not in ('linear', 'rbf'):
+            raise ValueError('Unsupported SVM kernel {}, only linear and rbf are implemented'.format(kernel))
+        if len(model['classes_']) != 2:
+            raise ValueError('Only binary SVMs are implemented, not {} classes'.format(len(model['classes_'])))
+        support_vectors = model['support_vectors_']
+        if kernel == 'linear':
+            kernel_values = np.dot(X, support_vectors.T)
+        else:
+            sq_distances = (np.sum(X ** 2, axis=1)[:, np.newaxis] - 2 * np.dot(X, support_vectors.T)
+                            + np.sum(support_vectors ** 2, axis=1)[np.newaxis, :])
+            kernel_values = np.exp(-model['_gamma'] * np.maximum(sq_distances, 0))
+        decision = np.dot(kernel_values, model['dual_coef_'].T) + model['intercept_']
+    return decision.ravel() if decision.shape[1] == 1 else decision
@@ -0,0 +1,50 @@
+"""
+Onset detection functions of a whole song, computed in a single streaming pass over its audio.
+
+The frames are windowed and transformed in blocks of BLOCK_FRAMES frames with a real FFT, and only the onset detection
+function values of each frame are kept. The peak memory of the pass therefore depends on the block size and not on the
+length of the song, unlike a spectrogram of the whole song, which is four times the size of its audio.
+"""
+import numpy as np
+from essentia.standard import Windowing, OnsetDetection, FrameGenerator
+
+# The onset detection functions used by the annotation modules: melflux by the beat tracker, hfc for the onset curve,
+# and flux and complex by the downbeat tracker
+ODF_METHODS = ('melflux', 'hfc', 'flux', 'complex')
+BLOCK_FRAMES = 256
+
+
+def onset_detection_functions(audio, methods=ODF_METHODS, frame_size=1024, hop_size=512, block_frames=BLOCK_FRAMES):
+    """
+    Returns a dict with the onset detection function of each method, as an array with one value per frame.
+
+    The onset detection functions have always been given the full spectrum of each frame, also in the data the downbeat
+    model was trained on. The real FFT only yields its first half, and the second half is restored from it per block as
+    its complex conjugate, so the values are the same as with a complex FFT of the whole song.
+    """
+    w = Windowing(type='hann')
+    odfs = {method: OnsetDetection(method=method) for method in methods}
+    result = {method: [] for method in methods}
+    block = np.zeros((block_frames, frame_size), dtype='single')
+
+    def process_block(num_frames):
+        fft_result = np.fft.rfft(block[:num_frames]).astype('complex64')
+        fft_result_mag = np.absolute(fft_result)
+        fft_result_ang = np.angle(fft_result)
+        fft_result_mag = np.concatenate((fft_result_mag, fft_result_mag[:, -2:0:-1]), axis=1)
+        fft_result_ang = np.concatenate((fft_result_ang, -fft_result_ang[:, -2:0:-1]), axis=1)
+        for mag, phase in zip(fft_result_mag, fft_result_ang):
+            for method, odf in odfs.items():
+                result[method].append(odf(mag, phase))
+
+    num_frames = 0
+    for frame in FrameGenerator(audio, frameSize=frame_size, hopSize=hop_size):
+        block[num_frames] = w(frame)
+        num_frames += 1
+        if num_frames == block_frames:
+            process_block(num_frames)
+            num_frames = 0
+    if num_frames > 0:
+        process_block(num_frames)
+
+    return {method: np.array(values, dtype='single') for method, values in result.items()}
@@ -4,24 +4,32 @@ import essentia
 import essentia.standard as ess
 import numpy as np
 import scipy
-from sklearn.externals import joblib
+
+from .. import npmodels
 
 
 class SingingVoiceDetector:
     def __init__(self, ):
         basepath = os.path.dirname(os.path.abspath(__file__))
-        self.singing_model = joblib.load(os.path.join(basepath, 'singingvoice_model.pkl'))
-        self.singing_scaler = joblib.load(os.path.join(basepath, 'singingvoice_scaler.pkl'))
+        self.singing_model = npmodels.load_model(basepath, 'singingvoice_model')
+        self.singing_scaler = npmodels.load_model(basepath, 'singingvoice_scaler')
 
-    def _calculate_features_for_audio(self, audio):
-        FRAME_SIZE, HOP_SIZE = 2048, 1024
+    def _calculate_features_for_audio(self, audio, sample_rate=44100):
+        FRAME_SIZE = 2048 * sample_rate // 44100  # Same frequency resolution at every sample rate
+        HOP_SIZE = FRAME_SIZE // 2
         features = []
         low_f = 100
         high_f = 7000
         w = ess.Windowing(type='hann')
         spec = ess.Spectrum(size=FRAME_SIZE)
-        mfcc = ess.MFCC(lowFrequencyBound=low_f, highFrequencyBound=high_f)
-        spectralContrast = ess.SpectralContrast(lowFrequencyBound=low_f, highFrequencyBound=high_f)
+        mfcc = ess.MFCC(lowFrequencyBound=low_f, highFrequencyBound=high_f, sampleRate=sample_rate,
+                        inputSize=FRAME_SIZE // 2 + 1)
+        # The model was trained with the spectral contrast at its default sample rate of 22050 Hz on 44.1 kHz audio, so
+        # its bands are at twice the frequencies of its bounds. At lower sample rates the upper bound is limited to the
+        # Nyquist frequency.
+        spectralContrast = ess.SpectralContrast(frameSize=FRAME_SIZE, sampleRate=sample_rate / 2,
+                                                lowFrequencyBound=low_f,
+                                                highFrequencyBound=min(high_f, sample_rate / 4))
         pool = essentia.Pool()
 
         for frame in ess.FrameGenerator(audio, frameSize=FRAME_SIZE, hopSize=HOP_SIZE):
@@ -51,14 +59,25 @@ class SingingVoiceDetector:
 
         return np.array(features, dtype='single')
 
-    def __call__(self, audio, downbeats):
+    def __call__(self, audio, downbeats, sample_rate=44100):
+        return self.detect_batch([(audio, downbeats)], sample_rate)[0]
+
+    def detect_batch(self, songs, sample_rate=44100):
+        """
+        Detects singing voice in every downbeat of several songs, given as (audio, downbeats) tuples. The features of
+        all songs are classified in one call.
+        """
+        X = [self.features(audio, downbeats, sample_rate) for audio, downbeats in songs]
+        X_scaled = npmodels.standard_scale(np.concatenate(X), self.singing_scaler)
+        decision = np.array(npmodels.svm_decision_function(X_scaled, self.singing_model), dtype='single')
+        return np.split(decision, np.cumsum([len(x) for x in X])[:-1])
+
+    def features(self, audio, downbeats, sample_rate=44100):
         features = []
         for dbeat_idx in range(len(downbeats) - 1):
-            start = int(downbeats[dbeat_idx] * 44100)
-            stop = int(downbeats[dbeat_idx + 1] * 44100)
+            start = int(downbeats[dbeat_idx] * sample_rate)
+            stop = int(downbeats[dbeat_idx + 1] * sample_rate)
             if start >= len(audio):
                 break
-            features.append(self._calculate_features_for_audio(audio[start:stop]))
-        X = np.array(features)
-
-        return np.array(self.singing_model.decision_function(self.singing_scaler.transform(X)), dtype='single')
+            features.append(self._calculate_features_for_audio(audio[start:stop], sample_rate))
+        return np.array(features)
@@ -1,11 +0,0 @@
-import os
-import pickle
-
-from sklearn.externals import joblib
-
-with open('song_theme_pca_model_pickle.pkl', 'rb') as f:
-    theme_pca = pickle.load(f, encoding='latin1')
-
-print(theme_pca)
-
-joblib.dump(theme_pca, os.path.join('song_theme_pca_model_python3.pkl'))
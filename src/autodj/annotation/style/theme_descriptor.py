@@ -3,7 +3,8 @@ import os
 import essentia
 import essentia.standard as ess
 import numpy as np
-from sklearn.externals import joblib
+
+from .. import npmodels
 
 basepath = os.path.dirname(os.path.abspath(__file__))
 
@@ -12,17 +13,29 @@ class ThemeDescriptorEstimator:
 
     def __init__(self, ):
         basepath = os.path.dirname(os.path.abspath(__file__))
-        self.theme_scaler = joblib.load(os.path.join(basepath, 'song_theme_scaler_2.pkl'))
-        self.theme_pca = joblib.load(os.path.join(basepath, 'song_theme_pca_model_python3.pkl'))
-
-    def __call__(self, audio, slices):
-        FRAME_SIZE = 2048
+        self.theme_scaler = npmodels.load_model(basepath, 'song_theme_scaler_2')
+        self.theme_pca = npmodels.load_model(basepath, 'song_theme_pca_model_python3')
+
+    def __call__(self, audio, slices, sample_rate=44100):
+        return self.estimate_batch([(audio, slices)], sample_rate)[0]
+
+    def estimate_batch(self, songs, sample_rate=44100):
+        """
+        Theme descriptors of several songs, given as (audio, slices) tuples, projected in one call. Returns one
+        (1, num_components) array per song.
+        """
+        features = np.concatenate([self.features(audio, slices, sample_rate) for audio, slices in songs])
+        result = npmodels.pca_transform(npmodels.standard_scale(features, self.theme_scaler), self.theme_pca)
+        return np.split(result.astype('single'), len(songs))
+
+    def features(self, audio, slices, sample_rate=44100):
+        FRAME_SIZE = 2048 * sample_rate // 44100  # Same frequency resolution at every sample rate
         HOP_SIZE = FRAME_SIZE // 2
 
         spec = ess.Spectrum(size=FRAME_SIZE)
         w = ess.Windowing(type='hann')
         pool = essentia.Pool()
-        specContrast = ess.SpectralContrast(frameSize=FRAME_SIZE, sampleRate=44100, numberBands=12)
+        specContrast = ess.SpectralContrast(frameSize=FRAME_SIZE, sampleRate=sample_rate, numberBands=12)
 
         for start_sample, end_sample in slices:
             for frame in ess.FrameGenerator(audio[start_sample:end_sample], frameSize=FRAME_SIZE, hopSize=HOP_SIZE):
@@ -40,7 +53,4 @@ class ThemeDescriptorEstimator:
         specValleyDeltas = np.average(np.abs(calculateDeltas(pool['audio.spectralValley'])), axis=0)
         features = np.concatenate((specCtrstAvgs, specValleyAvgs, specCtrstDeltas, specValleyDeltas))
 
-        result = self.theme_pca.transform(
-            self.theme_scaler.transform(features.astype('single').reshape((1, -1)))).astype('single')
-
-        return result
+        return features.astype('single').reshape((1, -1))
@@ -3,9 +3,6 @@ import logging
 import os
 
 import numpy as np
-from essentia import *
-from essentia.standard import *
-from essentia.standard import AudioOnsetsMarker
 
 ANNOT_SUBDIR = '_annot_auto/'
 ANNOT_DOWNB_PREFIX = 'downbeats_'
@@ -125,6 +122,7 @@ def writeBinaryAnnotFile(directory, song_title, prefix, array):
 
 
 def overlayAudio(audio, beats):
+    from essentia.standard import AudioOnsetsMarker
     onsetMarker = AudioOnsetsMarker(onsets=1.0 * beats)
     audioMarked = onsetMarker(audio)
     return audioMarked
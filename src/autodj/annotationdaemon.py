@@ -0,0 +1,142 @@
+"""
+Annotation daemon: annotates the songs submitted to the annotation queue by the DJ application (with the
+`annotate daemon` command) or from the command line, in its own worker processes and at a lower priority than
+playback:
+
+    python3 -m autodj.annotationdaemon --workers 2 --nice 10
+    python3 -m autodj.annotationdaemon submit /home/username/music/track
+    python3 -m autodj.annotationdaemon status
+
+The annotations are written next to the audio files, where DJ instances find them when they rescan their directories.
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import time
+
+from colorlog import ColoredFormatter
+
+from .dj import song
+from .dj.annotationqueue import AnnotationQueue, ANNOTATION_QUEUE_DIR
+from .dj.annotators.wrappers import default_annotation_modules, ANNOTATION_PROFILE, ANNOTATION_PROFILES
+from .dj.songcollection import ANNOTATION_BATCH_SIZE
+
+LOG_LEVEL = logging.INFO
+LOGFORMAT = "%(log_color)s%(message)s%(reset)s"
+POLL_INTERVAL = 2.0
+
+logging.root.setLevel(LOG_LEVEL)
+formatter = ColoredFormatter(LOGFORMAT)
+stream = logging.StreamHandler()
+stream.setLevel(LOG_LEVEL)
+stream.setFormatter(formatter)
+logger = logging.getLogger('colorlogger')
+logger.setLevel(LOG_LEVEL)
+logger.addHandler(stream)
+
+
+def annotate_jobs(queue, jobs, annotation_modules):
+    songs, song_jobs = [], []
+    for job_file, job in jobs:
+        if not os.path.isfile(job['path']):
+            queue.finish(job_file, job, error='File not found')
+            continue
+        s = song.Song(job['path'], annotation_modules=annotation_modules)
+        s.open()
+        if s.hasAllAnnot():
+            queue.finish(job_file, job, seconds=0.0)
+        else:
+            songs.append(s)
+            song_jobs.append((job_file, job))
+    if len(songs) == 0:
+        return
+
+    start = time.perf_counter()
+    try:
+        song.annotate_songs(songs)
+        seconds_per_song = (time.perf_counter() - start) / len(songs)
+        for job_file, job in song_jobs:
+            queue.finish(job_file, job, seconds=seconds_per_song)
+            logger.info('Annotated ' + job['path'])
+    except Exception:
+        # Annotate the songs one by one, to fail only the jobs of the songs that cannot be annotated. The modules that
+        # finished in the batch are not run again.
+        for job_file, job in song_jobs:
+            start = time.perf_counter()
+            try:
+                song.annotate_songs([song.Song(job['path'], annotation_modules=annotation_modules)])
+                queue.finish(job_file, job, seconds=time.perf_counter() - start)
+                logger.info('Annotated ' + job['path'])
+            except Exception as e:
+                queue.finish(job_file, job, error='{}: {}'.format(type(e).__name__, e))
+                logger.error('Annotating {} failed: {}'.format(job['path'], e))
+
+
+def worker_loop(queue_dir, niceness, batch_size, profile):
+    if niceness:
+        os.nice(niceness)
+    queue = AnnotationQueue(queue_dir)
+    annotation_modules = default_annotation_modules(profile)
+    while True:
+        jobs = queue.claim(batch_size)
+        if len(jobs) == 0:
+            time.sleep(POLL_INTERVAL)
+            continue
+        annotate_jobs(queue, jobs, annotation_modules)
+
+
+def submit(queue, paths):
+    audio_paths = []
+    for path in paths:
+        if os.path.isdir(path):
+            audio_paths.extend(os.path.join(path, f) for f in sorted(os.listdir(path))
+                               if f.endswith('.wav') or f.endswith('.mp3'))
+        else:
+            audio_paths.append(path)
+    logger.info('Submitted {} of {} songs'.format(queue.submit(audio_paths), len(audio_paths)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Annotate the songs submitted to the annotation queue.')
+    parser.add_argument('command', nargs='?', default='run', choices=['run', 'submit', 'status'])
+    parser.add_argument('paths', nargs='*', help='audio files or directories to submit')
+    parser.add_argument('--queue', default=ANNOTATION_QUEUE_DIR, help='annotation queue directory')
+    parser.add_argument('--workers', type=int, default=max(1, multiprocessing.cpu_count() // 2))
+    parser.add_argument('--nice', type=int, default=10, help='niceness increment of the worker processes')
+    parser.add_argument('--batch-size', type=int, default=ANNOTATION_BATCH_SIZE)
+    parser.add_argument('--profile', default=ANNOTATION_PROFILE, choices=ANNOTATION_PROFILES,
+                        help='annotation profile, fast analyses the key, theme and singing voice at a lower sample rate')
+    args = parser.parse_args()
+
+    queue = AnnotationQueue(args.queue)
+    if args.command == 'submit':
+        submit(queue, args.paths)
+        return
+    if args.command == 'status':
+        logger.info(', '.join('{} {}'.format(count, state) for state, count in queue.counts().items()))
+        return
+
+    num_requeued = queue.requeue_stale()
+    if num_requeued:
+        logger.info('Requeued {} jobs of workers that stopped'.format(num_requeued))
+    logger.info('Annotating the jobs in {} with {} workers ({} profile)'.format(args.queue, args.workers, args.profile))
+    worker_args = (args.queue, args.nice, args.batch_size, args.profile)
+    workers = [multiprocessing.Process(target=worker_loop, args=worker_args, daemon=True) for _ in range(args.workers)]
+    for worker in workers:
+        worker.start()
+    try:
+        while True:
+            time.sleep(POLL_INTERVAL)
+            for i, worker in enumerate(workers):
+                if not worker.is_alive():
+                    logger.warning('Worker {} stopped, restarting it'.format(worker.pid))
+                    queue.requeue_stale()
+                    workers[i] = multiprocessing.Process(target=worker_loop, args=worker_args, daemon=True)
+                    workers[i].start()
+    except KeyboardInterrupt:
+        logger.info('Goodbye!')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""
+Sharded annotation: annotates a large library on several machines that only share files, without the annotation
+queue of the daemon. A manifest of the songs that are not annotated yet is exported from the collection, each machine
+annotates one shard of it into its own output directory, and the outputs are imported back into the library:
+
+    python3 -m autodj.annotationshards export /archive/music --manifest archive.json
+    python3 -m autodj.annotationshards annotate archive.json --shard 3/8 --output /scratch/shard3 --library /mnt/music
+    python3 -m autodj.annotationshards import archive.json /scratch/shard0 /scratch/shard1 ...
+
+A shard that was interrupted continues where it stopped when it is started again. Annotations that conflict with the
+library (the audio file changed, or the song was annotated differently meanwhile) or with another shard are reported
+and not imported.
+"""
+import argparse
+import logging
+import sys
+
+from colorlog import ColoredFormatter
+
+from .dj.annotationmanifest import AnnotationManifest, annotate_shard
+from .dj.annotators.wrappers import default_annotation_modules, ANNOTATION_PROFILE, ANNOTATION_PROFILES
+from .dj.songcollection import SongCollection, ANNOTATION_BATCH_SIZE
+
+LOG_LEVEL = logging.INFO
+LOGFORMAT = "%(log_color)s%(message)s%(reset)s"
+
+logging.root.setLevel(LOG_LEVEL)
+formatter = ColoredFormatter(LOGFORMAT)
+stream = logging.StreamHandler()
+stream.setLevel(LOG_LEVEL)
+stream.setFormatter(formatter)
+logger = logging.getLogger('colorlogger')
+logger.setLevel(LOG_LEVEL)
+logger.addHandler(stream)
+
+
+def parse_shard(shard):
+    try:
+        shard_index, num_shards = (int(n) for n in shard.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected <shard>/<number of shards>, such as 3/8')
+    if not 0 <= shard_index < num_shards:
+        raise argparse.ArgumentTypeError('the shard must be between 0 and {}'.format(num_shards - 1))
+    return shard_index, num_shards
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Annotate a library in shards on several machines.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = subparsers.add_parser('export', help='export a manifest of the songs that are not annotated yet')
+    export_parser.add_argument('directories', nargs='+')
+    export_parser.add_argument('--manifest', required=True, help='file to write the manifest to')
+    export_parser.add_argument('--profile', default=ANNOTATION_PROFILE, choices=ANNOTATION_PROFILES,
+                               help='annotation profile of all shards')
+
+    annotate_parser = subparsers.add_parser('annotate', help='annotate one shard of a manifest')
+    annotate_parser.add_argument('manifest')
+    annotate_parser.add_argument('--shard', type=parse_shard, required=True, help='<shard>/<number of shards>')
+    annotate_parser.add_argument('--output', required=True, help='directory to write the annotations of the shard to')
+    annotate_parser.add_argument('--library', help='path of the library on this machine, if not the exported one')
+    annotate_parser.add_argument('--batch-size', type=int, default=ANNOTATION_BATCH_SIZE)
+
+    import_parser = subparsers.add_parser('import', help='merge the annotations of shards into the library')
+    import_parser.add_argument('manifest')
+    import_parser.add_argument('shards', nargs='+', help='output directories of the shards')
+
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        collection = SongCollection(default_annotation_modules(args.profile))
+        for directory in args.directories:
+            collection.load_directory(directory)
+        collection.export_annotation_manifest(args.manifest, args.profile)
+    elif args.command == 'annotate':
+        shard_index, num_shards = args.shard
+        num_done, num_failed = annotate_shard(AnnotationManifest.load(args.manifest), shard_index, num_shards,
+                                              args.output, args.library, batch_size=args.batch_size)
+        sys.exit(1 if num_failed else 0)
+    elif args.command == 'import':
+        manifest = AnnotationManifest.load(args.manifest)
+        collection = SongCollection(default_annotation_modules(manifest.profile))
+        _, conflicts = collection.import_annotation_shards(manifest, args.shards)
+        sys.exit(1 if conflicts else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+import json
+import logging
+import os
+import socket
+import tempfile
+import time
+import uuid
+
+from . import song
+from .annotators.wrappers import default_annotation_modules
+from ..annotation.util import ANNOT_SUBDIR
+
+logger = logging.getLogger('colorlogger')
+
+SHARD_INDEX_FILE = 'shard.json'
+DONE, FAILED = 'done', 'failed'
+
+
+def _write_json(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def _read_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def _annotation_file(directory, relative_path):
+    relative_dir, filename = os.path.split(relative_path)
+    return os.path.join(directory, relative_dir, ANNOT_SUBDIR, os.path.splitext(filename)[0] + '.json')
+
+
+class AnnotationManifest:
+    """
+    Songs of a collection that are not annotated yet, to be annotated in shards by several machines that only share
+    files. The songs are listed by their path relative to root, with the modification time and size of their audio file
+    when the manifest was exported; a machine that has the library elsewhere maps root to its own path. Shard i of n
+    holds every n-th song from the i-th on, so the shards are disjoint and all have about the same size.
+    """
+
+    def __init__(self, root, songs, profile, manifest_id=None, created=None):
+        self.root = root
+        self.songs = songs  # [{'path': path relative to root, 'stat': [mtime_ns, size]}]
+        self.profile = profile
+        self.id = manifest_id if manifest_id is not None else uuid.uuid4().hex
+        self.created = created if created is not None else time.time()
+
+    @classmethod
+    def load(cls, path):
+        data = _read_json(path)
+        return cls(data['root'], data['songs'], data['profile'], data['id'], data['created'])
+
+    def save(self, path):
+        _write_json(os.path.abspath(path), {
+            'id': self.id,
+            'created': self.created,
+            'root': self.root,
+            'profile': self.profile,
+            'songs': self.songs,
+        })
+
+    def shard(self, shard_index, num_shards):
+        if not 0 <= shard_index < num_shards:
+            raise ValueError('Invalid shard {} of {}'.format(shard_index, num_shards))
+        return self.songs[shard_index::num_shards]
+
+    def local_path(self, entry, library=None):
+        return os.path.join(self.root if library is None else library, entry['path'])
+
+
+class ShardIndex:
+    """
+    Record of the songs of a shard that were annotated, kept in the output directory of the shard next to the
+    annotation files, so an interrupted shard resumes where it stopped and the import step knows what to merge.
+    """
+
+    def __init__(self, output_dir, manifest=None, shard_index=None, num_shards=None):
+        self.path = os.path.join(output_dir, SHARD_INDEX_FILE)
+        try:
+            self.data = _read_json(self.path)
+        except FileNotFoundError:
+            if manifest is None:
+                raise
+            self.data = {'manifest_id': manifest.id, 'shard': shard_index, 'num_shards': num_shards,
+                         'profile': manifest.profile, 'host': socket.gethostname(), 'songs': {}}
+        if manifest is not None and (self.data['manifest_id'], self.data['shard'], self.data['num_shards']) != (
+                manifest.id, shard_index, num_shards):
+            raise ValueError('{} holds shard {} of {} of manifest {}'.format(
+                output_dir, self.data['shard'], self.data['num_shards'], self.data['manifest_id']))
+
+    @property
+    def songs(self):
+        return self.data['songs']
+
+    def finish(self, entry, seconds=None, error=None):
+        record = {'stat': entry['stat'], 'status': DONE if error is None else FAILED, 'finished': time.time(),
+                  'seconds': seconds}
+        if error is not None:
+            record['error'] = error
+        self.songs[entry['path']] = record
+
+    def save(self):
+        _write_json(self.path, self.data)
+
+
+def annotate_shard(manifest, shard_index, num_shards, output_dir, library=None, annotation_modules=None,
+                   batch_size=8):
+    """
+    Annotates the songs of shard shard_index of num_shards of the manifest that were not annotated by an earlier run,
+    writing their annotations to output_dir (in the same directory structure as the library). Returns the numbers of
+    songs annotated and failed.
+    """
+    if annotation_modules is None:
+        annotation_modules = default_annotation_modules(manifest.profile)
+    index = ShardIndex(output_dir, manifest, shard_index, num_shards)
+    entries = [entry for entry in manifest.shard(shard_index, num_shards)
+               if index.songs.get(entry['path'], {}).get('status') != DONE]
+    logger.info('Annotating {} songs of shard {} of {}'.format(len(entries), shard_index, num_shards))
+
+    def new_song(entry):
+        annotation_dir = os.path.dirname(_annotation_file(output_dir, entry['path']))
+        return song.Song(manifest.local_path(entry, library), annotation_modules=annotation_modules,
+                         annotation_dir=annotation_dir)
+
+    num_done, num_failed = 0, 0
+    for i in range(0, len(entries), batch_size):
+        batch = []
+        for entry in entries[i:i + batch_size]:
+            try:
+                size = os.stat(manifest.local_path(entry, library)).st_size
+            except FileNotFoundError:
+                index.finish(entry, error='File not found')
+                continue
+            # Copies of the library keep the size of the files but not always their modification time
+            if size != entry['stat'][1]:
+                index.finish(entry, error='File differs from the one in the manifest')
+            else:
+                batch.append(entry)
+
+        start = time.perf_counter()
+        try:
+            if len(batch) > 0:
+                song.annotate_songs([new_song(entry) for entry in batch])
+            seconds_per_song = (time.perf_counter() - start) / max(1, len(batch))
+            for entry in batch:
+                index.finish(entry, seconds=seconds_per_song)
+        except Exception:
+            # As in the annotation daemon: annotate the songs one by one, to fail only those that cannot be annotated
+            for entry in batch:
+                start = time.perf_counter()
+                try:
+                    song.annotate_songs([new_song(entry)])
+                    index.finish(entry, seconds=time.perf_counter() - start)
+                except Exception as e:
+                    index.finish(entry, error='{}: {}'.format(type(e).__name__, e))
+                    logger.error('Annotating {} failed: {}'.format(entry['path'], e))
+        index.save()
+
+        statuses = [index.songs[entry['path']]['status'] for entry in entries[i:i + batch_size]]
+        num_done += statuses.count(DONE)
+        num_failed += statuses.count(FAILED)
+        logger.info('{} of {} songs annotated, {} failed'.format(num_done, len(entries), num_failed))
+    return num_done, num_failed
+
+
+def import_shards(manifest, shard_dirs, library=None):
+    """
+    Merges the annotations of the shards in shard_dirs into the library. An annotation is not merged, but returned as
+    a conflict, if the shard belongs to another manifest, if shards disagree about the song, if its audio file was
+    changed or removed since the manifest was exported, or if the library already holds different annotations of the
+    song (other than those of an interrupted annotation). Returns the merged songs as (path, stat) tuples and the
+    conflicts as (song or shard, reason) tuples.
+    """
+    manifest_songs = {entry['path']: entry for entry in manifest.songs}
+    candidates, conflicts, conflicting_paths = {}, [], set()
+    for shard_dir in shard_dirs:
+        try:
+            index = ShardIndex(shard_dir)
+        except (FileNotFoundError, ValueError) as e:
+            conflicts.append((shard_dir, 'No shard index: {}'.format(e)))
+            continue
+        if index.data['manifest_id'] != manifest.id:
+            conflicts.append((shard_dir, 'Shard of another manifest ({})'.format(index.data['manifest_id'])))
+            continue
+        for relative_path, record in index.songs.items():
+            if record['status'] == FAILED:
+                logger.warning('{} could not be annotated in {}: {}'.format(relative_path, shard_dir, record['error']))
+            if record['status'] != DONE:
+                continue
+            if relative_path not in manifest_songs:
+                conflicts.append((relative_path, 'Not in the manifest'))
+                continue
+            data = _read_json(_annotation_file(shard_dir, relative_path))
+            if relative_path in candidates and candidates[relative_path][1] != data:
+                conflicts.append((relative_path, 'Annotated differently in {} and {}'.format(
+                    candidates[relative_path][0], shard_dir)))
+                conflicting_paths.add(relative_path)
+            candidates.setdefault(relative_path, (shard_dir, data))
+
+    merged = []
+    for relative_path, (shard_dir, data) in sorted(candidates.items()):
+        if relative_path in conflicting_paths:
+            continue
+        entry = manifest_songs[relative_path]
+        path = manifest.local_path(entry, library)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            conflicts.append((relative_path, 'Audio file was removed'))
+            continue
+        if [stat.st_mtime_ns, stat.st_size] != entry['stat']:
+            conflicts.append((relative_path, 'Audio file changed since the manifest was exported'))
+            continue
+
+        library_file = _annotation_file(manifest.root if library is None else library, relative_path)
+        try:
+            existing = _read_json(library_file)
+        except FileNotFoundError:
+            existing = {}
+        if all(key in existing for key in data):
+            if any(existing[key] != value for key, value in data.items()):
+                conflicts.append((relative_path, 'Annotated differently in the library since the export'))
+            continue
+        # Annotations of an interrupted annotation in the library are completed
+        existing.update(data)
+        _write_json(library_file, existing)
+        merged.append((path, entry['stat']))
+    return merged, conflicts
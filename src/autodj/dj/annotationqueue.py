@@ -0,0 +1,164 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+
+logger = logging.getLogger('colorlogger')
+
+ANNOTATION_QUEUE_DIR = os.environ.get('AUTODJ_ANNOTATION_QUEUE',
+                                      os.path.join(os.path.expanduser('~'), '.cache', 'autodj', 'annotation_queue'))
+
+PENDING, WORKING, DONE, FAILED = 'pending', 'working', 'done', 'failed'
+# Claims of a job whose worker stopped, after which it is failed rather than requeued, as it probably kills its worker
+MAX_JOB_ATTEMPTS = 3
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class AnnotationQueue:
+    """
+    Queue of songs to annotate, shared through the file system by the DJ instances and annotation daemons on a host.
+    Every job is a small JSON file named after the audio file it refers to, which moves from pending/ to working/ when a
+    worker claims it and to done/ or failed/ when it is finished. Claiming is an atomic rename, so each job is processed
+    by a single worker even with several daemons. The annotations themselves are written next to the audio files, as
+    when annotating in the application, where every instance reads them from.
+    """
+
+    def __init__(self, directory=ANNOTATION_QUEUE_DIR):
+        self.directory = directory
+        for state in (PENDING, WORKING, DONE, FAILED):
+            os.makedirs(os.path.join(directory, state), exist_ok=True)
+
+    @staticmethod
+    def job_name(path):
+        return hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest() + '.json'
+
+    def _path(self, state, name):
+        return os.path.join(self.directory, state, name)
+
+    def submit(self, paths):
+        """
+        Adds a job for each audio file in paths, unless it is already waiting or being annotated. Returns the number of
+        jobs added.
+        """
+        num_submitted = 0
+        for path in paths:
+            name = self.job_name(path)
+            if os.path.exists(self._path(PENDING, name)) or self.status(path) == WORKING:
+                continue
+            for state in (DONE, FAILED):
+                try:
+                    os.remove(self._path(state, name))
+                except FileNotFoundError:
+                    pass
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'path': os.path.abspath(path), 'submitted': time.time(), 'submitter': os.getpid()}, f)
+            os.replace(tmp_path, self._path(PENDING, name))
+            num_submitted += 1
+        return num_submitted
+
+    def status(self, path):
+        """
+        Returns the state of the job of the audio file path (pending, working, done or failed), or None.
+        """
+        name = self.job_name(path)
+        for state in (PENDING, DONE, FAILED):
+            if os.path.exists(self._path(state, name)):
+                return state
+        if any(n.startswith(name) for n in os.listdir(os.path.join(self.directory, WORKING))):
+            return WORKING
+        return None
+
+    def claim(self, max_jobs):
+        """
+        Claims up to max_jobs pending jobs, oldest first, for the calling process, and counts the attempt in the job
+        file. Returns (job file, job) tuples.
+        """
+        pending_dir = os.path.join(self.directory, PENDING)
+        names = sorted(os.listdir(pending_dir), key=lambda n: self._mtime(os.path.join(pending_dir, n)))
+        claimed = []
+        for name in names:
+            if len(claimed) >= max_jobs:
+                break
+            job_file = self._path(WORKING, '{}.{}'.format(name, os.getpid()))
+            try:
+                os.rename(self._path(PENDING, name), job_file)
+            except FileNotFoundError:
+                continue  # Claimed by another worker
+            try:
+                with open(job_file) as f:
+                    job = json.load(f)
+            except ValueError as e:
+                self.finish(job_file, {}, error='Invalid job file: {}'.format(e))
+                continue
+            job['attempts'] = job.get('attempts', 0) + 1
+            with open(job_file, 'w') as f:
+                json.dump(job, f)
+            claimed.append((job_file, job))
+        return claimed
+
+    @staticmethod
+    def _mtime(path):
+        try:
+            return os.stat(path).st_mtime
+        except FileNotFoundError:
+            return 0
+
+    def finish(self, job_file, job, seconds=None, error=None):
+        job = dict(job, finished=time.time(), seconds=seconds, worker=os.getpid())
+        if error is not None:
+            job['error'] = error
+        name = os.path.basename(job_file).rsplit('.', 1)[0]
+        state = DONE if error is None else FAILED
+        with open(job_file, 'w') as f:
+            json.dump(job, f)
+        os.replace(job_file, self._path(state, name))
+
+    def requeue_stale(self):
+        """
+        Moves the jobs claimed by processes that no longer exist back to pending, or to failed once they were claimed
+        MAX_JOB_ATTEMPTS times. Returns the number of requeued jobs.
+        """
+        num_requeued = 0
+        for job_name in os.listdir(os.path.join(self.directory, WORKING)):
+            name, pid = job_name.rsplit('.', 1)
+            if _pid_alive(int(pid)):
+                continue
+            job_file = self._path(WORKING, job_name)
+            try:
+                with open(job_file) as f:
+                    job = json.load(f)
+            except FileNotFoundError:
+                continue  # Requeued by another worker
+            except ValueError:
+                job = {}
+            try:
+                if job.get('attempts', 0) < MAX_JOB_ATTEMPTS:
+                    os.rename(job_file, self._path(PENDING, name))
+                    num_requeued += 1
+                    continue
+                # Moved before it is rewritten, so a job that another worker requeues meanwhile is not also failed
+                os.rename(job_file, self._path(FAILED, name))
+            except FileNotFoundError:
+                continue
+            job = dict(job, finished=time.time(),
+                       error='The worker stopped during each of its {} attempts'.format(job['attempts']))
+            with open(self._path(FAILED, name), 'w') as f:
+                json.dump(job, f)
+            logger.error('Annotating {} failed: {}'.format(job.get('path', name), job['error']))
+        return num_requeued
+
+    def counts(self):
+        return {state: len(os.listdir(os.path.join(self.directory, state)))
+                for state in (PENDING, WORKING, DONE, FAILED)}
@@ -1,12 +1,55 @@
-import essentia
-import essentia.standard
-
-from ...annotation.beat.beattracker import *
-from ...annotation.downbeat.downbeattracker import *
-from ...annotation.key.keyestimation import KeyEstimator
-from ...annotation.segmentation.structuralsegmentation import *
-from ...annotation.singing.singing_voice_detector import *
-from ...annotation.style.theme_descriptor import *
+import importlib
+import os
+
+import numpy as np
+
+SAMPLE_RATE = 44100
+
+ANNOTATION_PROFILES = ('full', 'fast')
+ANNOTATION_PROFILE = os.environ.get('AUTODJ_ANNOTATION_PROFILE', 'full')
+# The fast profile analyses the key, theme and singing voice at 22.05 kHz, which still covers the frequency ranges of all
+# their features
+FAST_PROFILE_DECIMATION = 2
+
+
+class LazyAnnotator:
+    """
+    Wrapper attribute holding an annotator that is only created when it is first used. The annotation modules import
+    Essentia and scikit-learn and load their models when they are created, which is not needed to check or load the
+    annotations of a song, so the import and the construction are deferred until the annotator actually has to run.
+    After the first use, the annotator is stored on the wrapper under the same name.
+    """
+
+    def __init__(self, module, name):
+        self.module = module
+        self.name = name
+        self.attr = None
+
+    def __set_name__(self, owner, attr):
+        self.attr = attr
+
+    def __get__(self, wrapper, owner=None):
+        if wrapper is None:
+            return self
+        module = importlib.import_module(self.module, __package__)
+        import essentia
+        essentia.log.infoActive = False
+        essentia.log.warningActive = False
+        annotator = getattr(module, self.name)()
+        wrapper.__dict__[self.attr] = annotator
+        return annotator
+
+
+def onset_detection_functions_of(song):
+    """
+    Returns the onset detection functions of the song. These are calculated along with the beats by the beat tracker;
+    when the beats were loaded from the annotations instead, they are calculated here and kept on the song for the next
+    annotation modules.
+    """
+    if song.odfs_1024_512 is None:
+        from ...annotation.onsetdetection import onset_detection_functions
+        song.odfs_1024_512 = onset_detection_functions(song.audio)
+    return song.odfs_1024_512
 
 
 class BaseAnnotationWrapper:
@@ -16,6 +59,13 @@ class BaseAnnotationWrapper:
     def process(self, song):
         raise NotImplementedError()
 
+    def process_batch(self, songs):
+        """
+        Returns the results of process() for each of the songs. Wrappers of model based annotators override this to
+        run the model once on the features of all songs.
+        """
+        return [self.process(song) for song in songs]
+
     def save_annotations_to_file(self, song, annotation_dir, file_handle=None):
         raise NotImplementedError()
 
@@ -30,12 +80,12 @@ class BaseAnnotationWrapper:
 
 
 class BeatAnnotationWrapper(BaseAnnotationWrapper):
-    def __init__(self):
-        super(BeatAnnotationWrapper, self).__init__()
-        self.beattracker = BeatTracker()
+    beattracker = LazyAnnotator('...annotation.beat.beattracker', 'BeatTracker')
 
     def process(self, s):
         self.beattracker.run(s.audio)
+        # The onset detection functions are kept on the song for the next modules, but not saved with the annotations
+        s.odfs_1024_512 = self.beattracker.odfs_1024_512
         return {
             'tempo': self.beattracker.bpm,
             'phase': self.beattracker.phase,
@@ -49,11 +99,7 @@ class BeatAnnotationWrapper(BaseAnnotationWrapper):
         spb = 60 / tempo
         result['tempo'] = np.around(song.tempo, 2)
         result['beats'] = (
-            np.arange(phase,
-                      (song.audio_length_samples / self.beattracker.SAMPLE_RATE) - spb + phase, spb).astype('single'))
-        if self.beattracker.fft_mag_1024_512 is not None:
-            result['fft_mag_1024_512'] = self.beattracker.fft_mag_1024_512
-            result['fft_phase_1024_512'] = self.beattracker.fft_phase_1024_512
+            np.arange(phase, (song.audio_length_samples / SAMPLE_RATE) - spb + phase, spb).astype('single'))
 
         return result
 
@@ -62,38 +108,14 @@ class BeatAnnotationWrapper(BaseAnnotationWrapper):
 
 
 class OnsetCurveAnnotationWrapper(BaseAnnotationWrapper):
-    def __init__(self):
-        super(OnsetCurveAnnotationWrapper, self).__init__()
-
     def process(self, song):
-        if song.fft_mag_1024_512 is None or song.fft_phase_1024_512 is None:
-            pool = essentia.Pool()
-            w = essentia.standard.Windowing(type='hann')
-            fft = np.fft.fft
-            FRAME_SIZE, HOP_SIZE = 2048, 512
-            for frame in essentia.standard.FrameGenerator(song.audio, frameSize=FRAME_SIZE, hopSize=HOP_SIZE):
-                pool.add('audio.windowed_frames', w(frame))
-
-            fft_result = fft(pool['audio.windowed_frames']).astype('complex64')
-            fft_result_mag = np.absolute(fft_result)
-            fft_result_ang = np.angle(fft_result)
-            song.fft_mag_1024_512 = fft_result_mag
-            song.fft_phase_1024_512 = fft_result_ang
-
-        fft_result_mag = song.fft_mag_1024_512
-        fft_result_ang = song.fft_phase_1024_512
-
-        od_hfc = essentia.standard.OnsetDetection(method='hfc')
-        pool = essentia.Pool()
-
-        for mag, phase in zip(fft_result_mag, fft_result_ang):
-            pool.add('onsets', od_hfc(mag, phase))
+        odf = onset_detection_functions_of(song)['hfc']
 
         def adaptive_mean(x, N):
             return np.convolve(x, [1.0] * int(N), mode='same') / N
 
-        novelty_mean = adaptive_mean(pool['onsets'], 16)
-        novelty_hwr = (pool['onsets'] - novelty_mean).clip(min=0)
+        novelty_mean = adaptive_mean(odf, 16)
+        novelty_hwr = (odf - novelty_mean).clip(min=0)
         novelty_hwr = novelty_hwr / np.average(novelty_hwr)
 
         return {'onset_curve': novelty_hwr.tolist()}
@@ -103,23 +125,24 @@ class OnsetCurveAnnotationWrapper(BaseAnnotationWrapper):
 
 
 class DownbeatAnnotationWrapper(BaseAnnotationWrapper):
-    def __init__(self):
-        super(DownbeatAnnotationWrapper, self).__init__()
-        self.dbeattracker = DownbeatTracker()
+    dbeattracker = LazyAnnotator('...annotation.downbeat.downbeattracker', 'DownbeatTracker')
 
     def process(self, song):
-        downbeats = self.dbeattracker.track(
-            song.audio, song.beats, song.fft_mag_1024_512, song.fft_phase_1024_512, song.onset_curve)
-        return {'downbeats': downbeats.tolist()}
+        return self.process_batch([song])[0]
+
+    def process_batch(self, songs):
+        all_downbeats = self.dbeattracker.track_batch([
+            (song.audio, song.beats, onset_detection_functions_of(song), song.onset_curve)
+            for song in songs])
+        return [{'downbeats': downbeats.tolist()} for downbeats in all_downbeats]
 
     def is_annotated_in(self, song):
         return hasattr(song, 'downbeats')
 
 
 class StructuralSegmentationWrapper(BaseAnnotationWrapper):
-    def __init__(self):
-        super(StructuralSegmentationWrapper, self).__init__()
-        self.structural_segmentator = StructuralSegmentator()
+    structural_segmentator = LazyAnnotator('...annotation.segmentation.structuralsegmentation',
+                                           'StructuralSegmentator')
 
     def process(self, song):
         segment_indices, segment_types = self.structural_segmentator.analyse(
@@ -145,10 +168,25 @@ class StructuralSegmentationWrapper(BaseAnnotationWrapper):
         return result
 
 
+class DecimatedAnnotationWrapper(BaseAnnotationWrapper):
+    """
+    Wrapper of an annotation module that can analyse the songs at SAMPLE_RATE divided by decimation. The decimated audio
+    is derived once per song and shared by the modules that use the same decimation.
+    """
+
+    def __init__(self, decimation=1):
+        self.decimation = decimation
+
+    @property
+    def sample_rate(self):
+        return SAMPLE_RATE // self.decimation
+
+    def analysed_audio(self, song):
+        return song.audio if self.decimation == 1 else song.decimated_audio(self.decimation)
+
+
 class ReplayGainWrapper(BaseAnnotationWrapper):
-    def __init__(self):
-        super(ReplayGainWrapper, self).__init__()
-        self.replay_gain = essentia.standard.ReplayGain()
+    replay_gain = LazyAnnotator('essentia.standard', 'ReplayGain')
 
     def process(self, song):
         rgain = self.replay_gain(song.audio)
@@ -158,34 +196,38 @@ class ReplayGainWrapper(BaseAnnotationWrapper):
         return hasattr(song, 'replaygain')
 
 
-class KeyEstimatorWrapper(BaseAnnotationWrapper):
-    def __init__(self):
-        super(KeyEstimatorWrapper, self).__init__()
-        self.key_estimator = KeyEstimator()
+class KeyEstimatorWrapper(DecimatedAnnotationWrapper):
+    key_estimator = LazyAnnotator('...annotation.key.keyestimation', 'KeyEstimator')
 
     def process(self, song):
-        key, scale = self.key_estimator(song.audio)
+        key, scale = self.key_estimator(self.analysed_audio(song), self.sample_rate)
         return {'key': key, 'scale': scale}
 
     def is_annotated_in(self, song):
         return hasattr(song, 'key') and hasattr(song, 'scale')
 
 
-class ThemeDescriptorWrapper(BaseAnnotationWrapper):
-    def __init__(self):
-        super(ThemeDescriptorWrapper, self).__init__()
-        self.theme_annotator = ThemeDescriptorEstimator()
+class ThemeDescriptorWrapper(DecimatedAnnotationWrapper):
+    theme_annotator = LazyAnnotator('...annotation.style.theme_descriptor', 'ThemeDescriptorEstimator')
 
     def process(self, song):
+        return self.process_batch([song])[0]
+
+    def process_batch(self, songs):
+        descriptors = self.theme_annotator.estimate_batch(
+            [(self.analysed_audio(song), self._high_segment_slices(song, self.sample_rate)) for song in songs],
+            self.sample_rate)
+        return [{'song_theme_descriptor': descriptor.tolist()} for descriptor in descriptors]
+
+    @staticmethod
+    def _high_segment_slices(song, sample_rate=SAMPLE_RATE):
         segments_high = [i for i in range(len(song.segment_types)) if song.segment_types[i] == 'H']
         slices = []
         for i in segments_high:
-            start_sample = int(44100 * song.downbeats[song.segment_indices[i]])
-            end_sample = int(44100 * song.downbeats[song.segment_indices[i + 1]])
+            start_sample = int(sample_rate * song.downbeats[song.segment_indices[i]])
+            end_sample = int(sample_rate * song.downbeats[song.segment_indices[i + 1]])
             slices.append((start_sample, end_sample))
-
-        song_theme_descriptor = self.theme_annotator(song.audio, slices)
-        return {'song_theme_descriptor': song_theme_descriptor.tolist()}
+        return slices
 
     def is_annotated_in(self, song):
         return hasattr(song, 'song_theme_descriptor')
@@ -194,17 +236,41 @@ class ThemeDescriptorWrapper(BaseAnnotationWrapper):
         return {'song_theme_descriptor': np.array(song.song_theme_descriptor)}
 
 
-class SingingVoiceWrapper(BaseAnnotationWrapper):
-    def __init__(self):
-        super(SingingVoiceWrapper, self).__init__()
-        self.singing_voice_detector = SingingVoiceDetector()
+class SingingVoiceWrapper(DecimatedAnnotationWrapper):
+    singing_voice_detector = LazyAnnotator('...annotation.singing.singing_voice_detector', 'SingingVoiceDetector')
 
     def process(self, song):
-        is_singing = self.singing_voice_detector(song.audio, song.downbeats)
-        return {'singing_voice': is_singing.tolist()}
+        return self.process_batch([song])[0]
+
+    def process_batch(self, songs):
+        all_singing = self.singing_voice_detector.detect_batch(
+            [(self.analysed_audio(song), song.downbeats) for song in songs], self.sample_rate)
+        return [{'singing_voice': is_singing.tolist()} for is_singing in all_singing]
 
     def is_annotated_in(self, song):
         return hasattr(song, 'singing_voice')
 
     def calculate_supplimentary_features(self, song):
         return {'singing_voice': np.array(song.singing_voice)}
+
+
+def default_annotation_modules(profile=ANNOTATION_PROFILE):
+    """
+    The annotation modules of the application, in the order they have to run. In the 'fast' profile, the tonal and
+    timbral features are analysed at a lower sample rate, which is less accurate (see ToolValidateAnnotationProfile).
+    The replay gain is always analysed at the full rate, as its equal loudness filter is only defined at 8, 32, 44.1
+    and 48 kHz.
+    """
+    if profile not in ANNOTATION_PROFILES:
+        raise ValueError('Unknown annotation profile {}, expected one of {}'.format(profile, ANNOTATION_PROFILES))
+    decimation = FAST_PROFILE_DECIMATION if profile == 'fast' else 1
+    return [
+        BeatAnnotationWrapper(),
+        OnsetCurveAnnotationWrapper(),
+        DownbeatAnnotationWrapper(),
+        StructuralSegmentationWrapper(),
+        ReplayGainWrapper(),
+        KeyEstimatorWrapper(decimation),
+        ThemeDescriptorWrapper(decimation),
+        SingingVoiceWrapper(decimation),
+    ]
@@ -1,33 +1,112 @@
-import bisect
 import csv
 import ctypes
 import logging
 import multiprocessing
+import queue
+import threading
+import time
+from collections import deque
 from multiprocessing import Process, Queue
+from threading import Thread
 from time import sleep
 
 import numpy as np
 import pyaudio
-from essentia.standard import MonoWriter, AudioWriter
 
 from . import songtransitions
 from . import tracklister
-from .timestretching import time_stretch_and_pitch_shift
+from .metrics import metrics
+from .mixtimeline import MixTimeline
+from .playbacktelemetry import PlaybackTelemetry
+from .profiling import ProfileControl
 
 logger = logging.getLogger('colorlogger')
 
+MIX_TIMELINE_CAPACITY = 44100 * 60 * 6
+# Seconds of rendered songs the DJ process may prepare ahead of the song that is currently being mixed
+PREFETCH_SECONDS = 60 * 4
+# Downbeats of the song skipped to that are rendered before the rest of it, so it starts as soon as possible
+SKIP_HEAD_DBEATS = 8
+# Minimum time between handing the new song to the player and the downbeat at which it starts
+SKIP_MARGIN_SECONDS = 0.3
+# How often the DJ process checks for skips while it waits
+SKIP_POLL_INTERVAL = 0.05
+
+
+class SkipRequested(Exception):
+    pass
+
+
+class PrefetchQueue:
+    """
+    Queue of prepared songs that is bounded by the amount of audio it holds instead of by the number of items. The
+    producer calls put() once a song has been rendered; it then blocks until the queue holds less than max_samples,
+    so it only starts preparing the next song when the lookahead has been used up by playback. An item is always
+    accepted, even when it is longer than max_samples on its own. After close(), put() no longer blocks, so the
+    producer can notice that its songs are not needed anymore.
+    """
+
+    def __init__(self, max_samples):
+        self.max_samples = max_samples
+        self.items = deque()
+        self.num_samples = 0
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def empty(self):
+        with self.cond:
+            return not self.items
+
+    def put(self, item, num_samples):
+        with self.cond:
+            self.items.append((item, num_samples))
+            self.num_samples += num_samples
+            self.cond.notify_all()
+            self.cond.wait_for(lambda: self.num_samples < self.max_samples or self.closed)
+
+    def get(self, timeout=None):
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.items, timeout):
+                raise queue.Empty()
+            item, num_samples = self.items.popleft()
+            self.num_samples -= num_samples
+            self.cond.notify_all()
+            return item
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.items.clear()
+            self.num_samples = 0
+            self.cond.notify_all()
+
 
 class DjController:
-    def __init__(self, tracklister, stereo=True):
+    def __init__(self, tracklister, stereo=True, prefetch_seconds=PREFETCH_SECONDS):
         self.tracklister = tracklister
         self.stereo = stereo
+        self.prefetch_seconds = prefetch_seconds
         self.audio_thread = None
         self.dj_thread = None
         self.playEvent = multiprocessing.Event()
         self.isPlaying = multiprocessing.Value('b', True)
         self.skipFlag = multiprocessing.Value('b', False)
+        # Skipping to a new song: the time of the last request, the position in the mix in samples at which the new
+        # song starts, and the generation of the queued audio, which is increased with every skip
+        self.skip_requested_at = multiprocessing.Value('d', 0.0)
+        self.cut_sample = multiprocessing.Value('q', 0)
+        self.generation = multiprocessing.Value('i', 0)
+        # Position of the player in the mix, in samples
+        self.play_position = multiprocessing.Value('q', 0)
         self.queue = Queue(6)
+        # Songs added to or removed from the collection while playing, applied by the DJ process to its own copy
+        self.collection_changes = Queue()
+        # Stage timings of the DJ process, merged into the metrics of this process when they are read
+        self.metrics_queue = Queue()
+        metrics.add_source(self.metrics_queue)
         self.currentMasterString = multiprocessing.Manager().Value(ctypes.c_char_p, '')
+        self.profile_control = ProfileControl()
+        self.telemetry = PlaybackTelemetry()
         self.pyaudio = None
         self.stream = None
         self.djloop_calculates_crossfade = False
@@ -46,6 +125,9 @@ class DjController:
             self.save_dir_idx = 0
             self.audio_to_save = []
             self.save_tracklist = []
+            self.telemetry.reset()
+            self.play_position.value = 0
+            self.skip_requested_at.value = 0.0
             if self.save_mix:
                 Process(target=self._flush_save_audio_buffer, args=(self.audio_save_queue,)).start()
             self.dj_thread = Process(target=self._dj_loop, args=(self.isPlaying,))
@@ -75,6 +157,8 @@ class DjController:
         self.save_tracklist = []
 
     def _flush_save_audio_buffer(self, queue):
+        from essentia.standard import MonoWriter, AudioWriter
+        self.profile_control.watch('save')
         while True:
             filename, audio, tracklist = queue.get()
             if not (filename is None):
@@ -93,6 +177,21 @@ class DjController:
                 logger.debug('Stopping audio saving thread!')
                 return
 
+    def notify_songs_changed(self, added_paths, removed_paths):
+        """
+        Tells the DJ process that the audio files added_paths were added to the song collection and removed_paths
+        were removed from it. A path in both lists is loaded again. The changes take effect from the next song
+        selection on.
+        """
+        if added_paths or removed_paths:
+            self.collection_changes.put((list(added_paths), list(removed_paths)))
+
+    def _apply_collection_changes(self):
+        while not self.collection_changes.empty():
+            added_paths, removed_paths = self.collection_changes.get()
+            added_songs, removed_songs = self.tracklister.song_collection.update_songs(added_paths, removed_paths)
+            self.tracklister.update_pool(added_songs, removed_songs)
+
     def skipToNextSegment(self):
         if not self.queue.empty():
             self.skipFlag.value = True
@@ -100,6 +199,14 @@ class DjController:
             self.skipFlag.value = False
             logger.warning('Cannot skip to next segment, no audio in queue!')
 
+    def skipToNextSong(self):
+        """
+        Leaves the current song at the next downbeat and continues the mix with a new song, entered at its drop.
+        """
+        if self.dj_thread is None:
+            raise Exception('Cannot skip to the next song, nothing is playing!')
+        self.skip_requested_at.value = time.time()
+
     def markCurrentMaster(self):
         with open('markfile.csv', 'a+') as csvfile:
             writer = csv.writer(csvfile)
@@ -132,20 +239,36 @@ class DjController:
         self.pyaudio = None
 
     def _audio_play_loop(self, playEvent, isPlaying, currentMasterString):
+        metrics.forward_to(self.metrics_queue)
+        self.profile_control.watch('audio')
         if self.pyaudio is None:
             self.pyaudio = pyaudio.PyAudio()
         if self.stream is None:
             self.stream = self.pyaudio.open(format=pyaudio.paFloat32, channels=1 if not self.stereo else 2, rate=44100,
                                             output=True)
+        masterTitle = None
+        playing_generation = self.generation.value
         while isPlaying.value:
-            toPlay, toPlayStr, masterTitle = self.queue.get()
-            logger.info(toPlayStr)
-            currentMasterString.value = masterTitle
+            if masterTitle is not None and self.queue.empty():
+                self.telemetry.starved(masterTitle)
+            toPlay, toPlayStr, masterTitle, generation, mix_start = self.queue.get()
             if toPlay is None:
+                logger.info(toPlayStr)
                 break
-            else:
-                if self.save_mix:
-                    self.save_audio_to_disk(toPlay, masterTitle)
+            self.telemetry.start_segment(toPlay.shape[-1])
+            # Audio queued before a skip is only played up to the downbeat where the new song starts
+            if generation < self.generation.value and mix_start >= self.cut_sample.value:
+                self.telemetry.end_segment()
+                continue
+            if generation > playing_generation:
+                playing_generation = generation
+                seconds = time.time() - self.skip_requested_at.value
+                metrics.observe('dj.skip', seconds)
+                self.telemetry.skipped(seconds, masterTitle)
+            logger.info(toPlayStr)
+            currentMasterString.value = masterTitle
+            if self.save_mix:
+                self.save_audio_to_disk(toPlay, masterTitle)
             FRAME_LEN = 1024
             last_frame_start_idx = int(toPlay.shape[-1] / FRAME_LEN) * FRAME_LEN
             for cur_idx in range(0, last_frame_start_idx + 1, FRAME_LEN):
@@ -159,11 +282,25 @@ class DjController:
                     end_idx = toPlay.shape[-1]
                 else:
                     end_idx = cur_idx + FRAME_LEN
+                self.play_position.value = mix_start + cur_idx
+                if generation < self.generation.value:
+                    end_idx = min(end_idx, self.cut_sample.value - mix_start)
+                    if end_idx <= cur_idx:
+                        break
                 toPlayNow = toPlay[..., cur_idx:end_idx]
                 if toPlayNow.dtype != 'float32':
                     toPlayNow = toPlayNow.astype('float32')
                 toPlayNow = np.copy(toPlayNow.T, order='C')
-                self.stream.write(toPlayNow, num_frames=toPlayNow.shape[0], exception_on_underflow=False)
+                try:
+                    self.stream.write(toPlayNow, num_frames=toPlayNow.shape[0], exception_on_underflow=True)
+                except IOError as e:
+                    # The frames are still written after an underflow, it is only reported. Depending on the PyAudio
+                    # version, the error code is the first or the second argument of the error
+                    if pyaudio.paOutputUnderflowed not in e.args:
+                        raise
+                    self.telemetry.underflow(masterTitle)
+                self.telemetry.played(toPlayNow.shape[0], masterTitle)
+            self.telemetry.end_segment()
         logger.debug('Stopping music')
         if self.save_mix:
             logger.debug('Flushing audio to disk...')
@@ -173,23 +310,18 @@ class DjController:
     def _dj_loop(self, isPlaying):
         TEMPO = 175
         samples_per_dbeat = 44100 * 4 * 60 / TEMPO
-        song_titles_in_buffer = []
-        tracklist_changes = []
-        num_songs_playing = 0
-        songs_playing_master = 0
-
-        def add_song_to_tracklist(master_song, anchor_sample, next_song, next_fade_type, cue_master_out, fade_in_len,
-                                  fade_out_len):
-            f = master_song.tempo / TEMPO
-            buffer_in_sample = int(f * (44100 * master_song.downbeats[cue_master_out] - anchor_sample))
-            buffer_switch_sample = int(
-                f * (44100 * master_song.downbeats[cue_master_out] - anchor_sample) + fade_in_len * samples_per_dbeat)
-            buffer_out_sample = int(f * (44100 * master_song.downbeats[cue_master_out] - anchor_sample) + (
-                    fade_in_len + fade_out_len) * samples_per_dbeat)
-            song_titles_in_buffer.append(next_song.title)
-            bisect.insort(tracklist_changes, (buffer_in_sample, 'in', next_fade_type))
-            bisect.insort(tracklist_changes, (buffer_switch_sample, 'switch', next_fade_type))
-            bisect.insort(tracklist_changes, (buffer_out_sample, 'out', next_fade_type))
+        metrics.forward_to(self.metrics_queue)
+        self.profile_control.watch('dj')
+        self._select_lock = threading.Lock()
+        timeline = MixTimeline(MIX_TIMELINE_CAPACITY, 2 if self.stereo else None)
+        generation = self.generation.value
+        skip_handled_at = self.skip_requested_at.value
+
+        def add_song_to_tracklist(prepared_song):
+            if prepared_song['next_title'] is not None:
+                song_titles_in_buffer.append(prepared_song['next_title'])
+            for buffer_sample, in_or_out, next_fade_type in prepared_song['events']:
+                timeline.add_event(mix_buffer_start + buffer_sample, in_or_out, next_fade_type)
 
         def curPlayingString(fade_type_str):
             outstr = 'Now playing:\n'
@@ -206,119 +338,260 @@ class DjController:
             self.audio_to_save = []
             self.save_tracklist = []
 
-        current_song = self.tracklister.getFirstSong()
-        current_song.open()
-        current_song.openAudio()
-        anchor_sample = 0
-        cue_master_in = current_song.segment_indices[0]
-        fade_in_len = 16
-        prev_fade_type = tracklister.TYPE_CHILL
-        logger.debug('FIRST SONG: {}'.format(current_song.title))
-
-        cue_master_out, next_fade_type, max_fade_in_len, fade_out_len = tracklister.getMasterQueue(
-            current_song, cue_master_in + fade_in_len, prev_fade_type)
-        next_song, cue_next_in, cue_master_out, fade_in_len, semitone_offset = \
-            self.tracklister.getBestNextSongAndCrossfade(
-                current_song, cue_master_out, max_fade_in_len, fade_out_len, next_fade_type)
-        song_titles_in_buffer.append(current_song.title)
-        add_song_to_tracklist(current_song, anchor_sample, next_song, next_fade_type, cue_master_out, fade_in_len,
-                              fade_out_len)
-        prev_in_or_out = 'in'
-
-        f = current_song.tempo / TEMPO
-        print(f'CURRENT SONG TEMPO, STRETCH: {current_song.tempo} {f}')
-        current_audio_start = 0
-        current_audio_end = int(
-            (current_song.downbeats[cue_master_out] * 44100) + (fade_in_len + fade_out_len + 2) * samples_per_dbeat / f)
-        if self.stereo:
-            current_audio_stretched = np.array((
-                time_stretch_and_pitch_shift(
-                    np.asfortranarray(current_song.audio_left[current_audio_start:current_audio_end]), f),
-                time_stretch_and_pitch_shift(
-                    np.asfortranarray(current_song.audio_right[current_audio_start:current_audio_end]), f)
-            ))
-        else:
-            current_audio_stretched = time_stretch_and_pitch_shift(
-                current_song.audio[current_audio_start:current_audio_end], f)
-
-        mix_buffer = current_audio_stretched
-        mix_buffer_cf_start_sample = int(f * (current_song.downbeats[cue_master_out] * 44100))
-
-        while True:
-            prev_end_sample = 0
-            for end_sample, in_or_out, cur_fade_type in tracklist_changes:
-
-                if end_sample > mix_buffer_cf_start_sample:
+        def start_preparing(skip_from=None):
+            prepared_songs = PrefetchQueue(int(self.prefetch_seconds * 44100))
+            Thread(target=self._prepare_songs, args=(prepared_songs, TEMPO, skip_from), daemon=True).start()
+            return prepared_songs
+
+        def next_prepared(interruptible=True):
+            if interruptible and prepared.empty():
+                logger.warning('Next song is not prepared yet, waiting for it')
+            while True:
+                if interruptible and self.skip_requested_at.value > skip_handled_at:
+                    raise SkipRequested()
+                try:
+                    item = prepared.get(timeout=SKIP_POLL_INTERVAL)
                     break
+                except queue.Empty:
+                    pass
+            if isinstance(item, Exception):
+                raise item
+            return item
+
+        def put_segment(toPlayTuple):
+            while True:
+                if self.skip_requested_at.value > skip_handled_at:
+                    raise SkipRequested()
+                try:
+                    self.queue.put(toPlayTuple, timeout=SKIP_POLL_INTERVAL)
+                    return
+                except queue.Full:
+                    pass
+
+        prepared = start_preparing()
+        current = next_prepared(interruptible=False)
+        mix_buffer_start = 0
 
-                if prev_in_or_out == 'in':
-                    num_songs_playing += 1
-                elif prev_in_or_out == 'out':
-                    num_songs_playing -= 1
-                    songs_playing_master -= 1
-                    song_titles_in_buffer = song_titles_in_buffer[1:]
-                elif prev_in_or_out == 'switch':
-                    songs_playing_master += 1
-                prev_in_or_out = in_or_out
-
-                if end_sample > prev_end_sample:
-                    toPlay = mix_buffer[..., prev_end_sample: end_sample]
-                    cur_fade_type_str = cur_fade_type if num_songs_playing > 1 else ''
-                    toPlayTuple = (
-                        toPlay, curPlayingString(cur_fade_type_str), song_titles_in_buffer[songs_playing_master])
-                    self.queue.put(toPlayTuple, isPlaying.value)
-                    prev_end_sample = end_sample
-
-            tracklist_changes = [(tc[0] - mix_buffer_cf_start_sample, tc[1], tc[2])
-                                 for tc in tracklist_changes if tc[0] > mix_buffer_cf_start_sample]
-            mix_buffer = mix_buffer[..., mix_buffer_cf_start_sample:]
-            current_song.close()
-
-            current_song = next_song
-            current_song.open()
-            f = current_song.tempo / TEMPO
-            cue_master_in = cue_next_in
-            prev_fade_type = next_fade_type
-            prev_fade_in_len = fade_in_len
-            prev_fade_out_len = fade_out_len
-
-            cue_master_out, next_fade_type, max_fade_in_len, fade_out_len = \
-                tracklister.getMasterQueue(current_song, cue_master_in + fade_in_len, prev_fade_type)
-            next_song, cue_next_in, cue_master_out, fade_in_len, semitone_offset = \
-                self.tracklister.getBestNextSongAndCrossfade(
-                    current_song, cue_master_out, max_fade_in_len, fade_out_len, next_fade_type)
-            anchor_sample = int(44100 * current_song.downbeats[cue_master_in])
-            add_song_to_tracklist(current_song, anchor_sample, next_song, next_fade_type, cue_master_out, fade_in_len,
-                                  fade_out_len)
-            mix_buffer_cf_start_sample = int(f * (current_song.downbeats[cue_master_out] * 44100 - anchor_sample))
-
-            f = current_song.tempo / TEMPO
-            current_song.openAudio()
-
-            current_audio_start = int(current_song.downbeats[cue_master_in] * 44100)
-            current_audio_end = int((current_song.downbeats[cue_master_out] * 44100) + (
-                    fade_in_len + fade_out_len + 2) * samples_per_dbeat / f)
+        while True:
+            # A new plan starts with the first prepared song, at the start of the mix or after a skip
+            song_titles_in_buffer = [current['title']]
+            num_songs_playing = 0
+            songs_playing_master = 0
+            prev_in_or_out = 'in'
+            # (sample from which the song is the master, sample where its audio starts, prepared song)
+            masters = deque([(mix_buffer_start, mix_buffer_start, current)], maxlen=4)
+            add_song_to_tracklist(current)
+            timeline.write(mix_buffer_start, current['audio'])
+            mix_buffer_cf_start_sample = mix_buffer_start + current['cf_start_sample']
+
+            try:
+                while True:
+                    prev_end_sample = mix_buffer_start
+                    for end_sample, in_or_out, cur_fade_type in timeline.pop_events(mix_buffer_cf_start_sample):
+
+                        if prev_in_or_out == 'in':
+                            num_songs_playing += 1
+                        elif prev_in_or_out == 'out':
+                            num_songs_playing -= 1
+                            songs_playing_master -= 1
+                            song_titles_in_buffer = song_titles_in_buffer[1:]
+                        elif prev_in_or_out == 'switch':
+                            songs_playing_master += 1
+                        prev_in_or_out = in_or_out
+
+                        if end_sample > prev_end_sample:
+                            toPlay = timeline.read(prev_end_sample, end_sample)
+                            timeline.consume(end_sample)
+                            cur_fade_type_str = cur_fade_type if num_songs_playing > 1 else ''
+                            toPlayTuple = (toPlay, curPlayingString(cur_fade_type_str),
+                                           song_titles_in_buffer[songs_playing_master], generation, prev_end_sample)
+                            self.telemetry.add_queued(toPlay.shape[-1])
+                            with metrics.timer('dj.queue_put'):
+                                put_segment(toPlayTuple)
+                            prev_end_sample = end_sample
+
+                    mix_buffer_start = mix_buffer_cf_start_sample
+                    timeline.consume(mix_buffer_start)
+
+                    current = next_prepared()
+                    add_song_to_tracklist(current)
+                    masters.append((mix_buffer_start + int(current['fade_in_len'] * samples_per_dbeat),
+                                    mix_buffer_start, current))
+                    mix_buffer_cf_start_sample = mix_buffer_start + current['cf_start_sample']
+
+                    # The rest of a song that was started by a skip is not crossfaded with its first part
+                    if not current['continuation']:
+                        cf = songtransitions.CrossFade(0, [0], current['fade_in_len'] + current['fade_out_len'],
+                                                       current['fade_in_len'], current['fade_type'])
+                        with metrics.timer('dj.crossfade'):
+                            mix_buffer_tail = timeline.read(mix_buffer_start, timeline.write_end)
+                            cf.apply(mix_buffer_tail, current['audio'], TEMPO, out=current['audio'])
+                    timeline.write(mix_buffer_start, current['audio'])
+
+            except SkipRequested:
+                skip_handled_at = self.skip_requested_at.value
+                position = self.play_position.value
+                playing_masters = [m for m in masters if m[0] <= position]
+                master = playing_masters[-1] if playing_masters else masters[0]
+                logger.debug('Skipping from {}'.format(master[2]['title']))
+
+                # Playback continues with the queued audio until the first part of the new song is ready
+                prepared.close()
+                prepared = start_preparing(master[2])
+                with metrics.timer('dj.skip_prepare'):
+                    current = next_prepared(interruptible=False)
+
+                # The new song starts on the first downbeat of the mix that the player has not reached yet
+                position = self.play_position.value + SKIP_MARGIN_SECONDS * 44100
+                grid_origin = master[1] + master[2]['cf_start_sample']
+                mix_buffer_start = int(round(
+                    grid_origin + np.ceil((position - grid_origin) / samples_per_dbeat) * samples_per_dbeat))
+                generation += 1
+                self.cut_sample.value = mix_buffer_start
+                self.generation.value = generation
+                timeline.reset(mix_buffer_start)
+
+    def _prepare_songs(self, prepared, TEMPO, skip_from=None):
+        """
+        Selects the songs of the mix and renders the played part of each of them, ahead of playback. Runs in a
+        background thread of the DJ process, so the next transitions are prepared while the current one is playing.
+        Each prepared song is put in the prepared queue, in mix order, as a dict with its time stretched audio and its
+        cue points in samples relative to the start of that audio. The crossfade into the song is left to the DJ loop,
+        since it needs the rendered tail of the previous song.
+
+        After a skip, skip_from is the prepared song that was playing. The mix then continues with a song chosen by
+        TrackLister.getSkipSong(), which is entered at its first drop without a crossfade. Its first SKIP_HEAD_DBEATS
+        downbeats are prepared separately, so that it can start playing before the rest of it is rendered. The thread
+        stops when the prepared queue is closed.
+        """
+        from .song import Song
+        from .timestretching import time_stretch_and_pitch_shift
+        samples_per_dbeat = 44100 * 4 * 60 / TEMPO
 
+        def stretch(song, f, semitones):
             if self.stereo:
-                current_audio_stretched = np.array((
-                    time_stretch_and_pitch_shift(
-                        np.asfortranarray(current_song.audio_left[current_audio_start:current_audio_end]), f,
-                        semitones=semitone_offset),
-                    time_stretch_and_pitch_shift(
-                        np.asfortranarray(current_song.audio_right[current_audio_start:current_audio_end]), f,
-                        semitones=semitone_offset)
+                return np.array((
+                    time_stretch_and_pitch_shift(np.asfortranarray(song.audio_left), f, semitones=semitones),
+                    time_stretch_and_pitch_shift(np.asfortranarray(song.audio_right), f, semitones=semitones)
                 ))
             else:
-                current_audio_stretched = time_stretch_and_pitch_shift(
-                    current_song.audio[current_audio_start:current_audio_end], f, semitones=semitone_offset)
+                return time_stretch_and_pitch_shift(song.audio, f, semitones=semitones)
 
-            cf = songtransitions.CrossFade(0, [0], prev_fade_in_len + prev_fade_out_len, prev_fade_in_len,
-                                           prev_fade_type)
-            if self.stereo:
-                mix_buffer_deepcpy = np.array(mix_buffer, dtype='single', copy=True)
-                mix_buffer_left = cf.apply(mix_buffer_deepcpy[0], current_audio_stretched[0], TEMPO)
-                mix_buffer_right = cf.apply(mix_buffer_deepcpy[1], current_audio_stretched[1], TEMPO)
-                mix_buffer = np.array((mix_buffer_left, mix_buffer_right), dtype='single', copy=True)
+        try:
+            keep_semitone_offset = False
+            is_continuation = False
+            if skip_from is None:
+                with self._select_lock, metrics.timer('dj.select'):
+                    current_song = self.tracklister.getFirstSong()
+                with metrics.timer('dj.open'):
+                    current_song.open()
+                logger.debug('FIRST SONG: {}'.format(current_song.title))
+                is_first_song = True
+                cue_master_in = current_song.segment_indices[0]
+                fade_in_len = 16
+                prev_fade_type = tracklister.TYPE_CHILL
+                semitone_offset = 0
             else:
-                mix_buffer_deepcpy = np.array(mix_buffer, dtype='single', copy=True)
-                mix_buffer = cf.apply(mix_buffer_deepcpy, current_audio_stretched, TEMPO)
+                # A copy, since the song object itself may still be in use by the thread that prepared it
+                master_song = Song(skip_from['song'].filepath, annotation_modules=skip_from['song'].annotation_modules)
+                master_song.open()
+                with self._select_lock, metrics.timer('dj.select'):
+                    current_song, cue_master_in, semitone_offset = self.tracklister.getSkipSong(
+                        master_song, skip_from['semitone_offset'])
+                with metrics.timer('dj.open'):
+                    current_song.open()
+                logger.debug('SKIPPING TO: {}'.format(current_song.title))
+                is_first_song = False
+                fade_in_len = 0
+                prev_fade_type = tracklister.TYPE_DOUBLE_DROP
+
+                f = current_song.tempo / TEMPO
+                head_end = min(cue_master_in + SKIP_HEAD_DBEATS, len(current_song.downbeats) - 1)
+                anchor_sample = int(44100 * current_song.downbeats[cue_master_in])
+                # One downbeat more is rendered, which the rest of the song overwrites
+                with metrics.timer('dj.open_audio'):
+                    current_song.openAudio(anchor_sample, int(44100 * current_song.downbeats[head_end]
+                                                              + samples_per_dbeat / f))
+                with metrics.timer('dj.stretch'):
+                    head_audio = stretch(current_song, f, semitone_offset)
+                current_song.closeAudio()
+                head_end_sample = int(f * (44100 * current_song.downbeats[head_end] - anchor_sample))
+                prepared.put({
+                    'title': current_song.title,
+                    'next_title': None,
+                    'audio': head_audio,
+                    'cf_start_sample': head_end_sample,
+                    'fade_type': prev_fade_type,
+                    'fade_in_len': 0,
+                    'fade_out_len': 0,
+                    'continuation': False,
+                    'events': [(head_end_sample, 'continue', None)],
+                    'song': current_song,
+                    'semitone_offset': semitone_offset,
+                }, head_audio.shape[-1])
+                cue_master_in = head_end
+                keep_semitone_offset = True
+                is_continuation = True
+            fade_out_len = None
+
+            while True:
+                prev_fade_in_len = fade_in_len
+                prev_fade_out_len = fade_out_len
+                self._apply_collection_changes()
+                with self._select_lock:
+                    if prepared.closed:
+                        return
+                    with metrics.timer('dj.select'):
+                        cue_master_out, next_fade_type, max_fade_in_len, fade_out_len = \
+                            tracklister.getMasterQueue(current_song, cue_master_in + fade_in_len, prev_fade_type)
+                        next_song, cue_next_in, cue_master_out, fade_in_len, next_semitone_offset = \
+                            self.tracklister.getBestNextSongAndCrossfade(
+                                current_song, cue_master_out, max_fade_in_len, fade_out_len, next_fade_type)
+                if not is_first_song and not keep_semitone_offset:
+                    semitone_offset = next_semitone_offset
+
+                f = current_song.tempo / TEMPO
+                # Only the played part of the song is decoded
+                anchor_sample = 0 if is_first_song else int(44100 * current_song.downbeats[cue_master_in])
+                current_audio_end = int((current_song.downbeats[cue_master_out] * 44100) + (
+                        fade_in_len + fade_out_len + 2) * samples_per_dbeat / f)
+                with metrics.timer('dj.open_audio'):
+                    current_song.openAudio(anchor_sample, current_audio_end)
+                with metrics.timer('dj.stretch'):
+                    current_audio_stretched = stretch(current_song, f, semitone_offset)
+
+                cue_out_sample = f * (44100 * current_song.downbeats[cue_master_out] - anchor_sample)
+                item = {
+                    'title': current_song.title,
+                    'next_title': next_song.title,
+                    'audio': current_audio_stretched,
+                    'cf_start_sample': int(cue_out_sample),
+                    'fade_type': prev_fade_type,
+                    'fade_in_len': prev_fade_in_len,
+                    'fade_out_len': prev_fade_out_len,
+                    'continuation': is_continuation,
+                    'events': [
+                        (int(cue_out_sample), 'in', next_fade_type),
+                        (int(cue_out_sample + fade_in_len * samples_per_dbeat), 'switch', next_fade_type),
+                        (int(cue_out_sample + (fade_in_len + fade_out_len) * samples_per_dbeat), 'out',
+                         next_fade_type),
+                    ],
+                    'song': current_song,
+                    'semitone_offset': semitone_offset,
+                }
+                current_song.close()
+                prepared.put(item, current_audio_stretched.shape[-1])
+                if prepared.closed:
+                    return
+
+                current_song = next_song
+                with metrics.timer('dj.open'):
+                    current_song.open()
+                is_first_song = False
+                keep_semitone_offset = False
+                is_continuation = False
+                cue_master_in = cue_next_in
+                prev_fade_type = next_fade_type
+        except Exception as e:
+            logger.exception('Preparing the next song failed')
+            prepared.put(e, 0)
@@ -0,0 +1,170 @@
+import logging
+import math
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+logger = logging.getLogger('colorlogger')
+
+METRICS_FILE = os.environ.get('AUTODJ_METRICS_FILE', '')
+METRICS_PORT = int(os.environ.get('AUTODJ_METRICS_PORT', 0))
+METRICS_EXPORT_INTERVAL = 10
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, math.inf)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """
+        Upper bound of the bucket that contains quantile q, which is as precise as a histogram can tell.
+        """
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class Metrics:
+    """
+    Timing histograms per stage of the DJ engine and of the annotation. Stages are timed with the timer() context
+    manager. A process can forward its observations to another process over a multiprocessing queue with
+    forward_to(); the receiving process registers that queue with add_source(), and its observations are merged in
+    whenever the histograms are read.
+    """
+
+    def __init__(self):
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.sink = None
+        self.sources = []
+
+    def observe(self, stage, seconds):
+        if self.sink is not None:
+            try:
+                self.sink.put_nowait((stage, seconds))
+            except queue.Full:
+                pass
+            return
+        with self.lock:
+            if stage not in self.histograms:
+                self.histograms[stage] = Histogram()
+            self.histograms[stage].observe(seconds)
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def forward_to(self, sink):
+        self.sink = sink
+
+    def add_source(self, source):
+        self.sources.append(source)
+
+    def collect(self):
+        for source in self.sources:
+            while True:
+                try:
+                    stage, seconds = source.get_nowait()
+                except (queue.Empty, EOFError, OSError):
+                    break
+                self.observe(stage, seconds)
+
+    def report(self):
+        self.collect()
+        with self.lock:
+            if not self.histograms:
+                return 'No timings recorded yet.'
+            lines = ['{:30s} {:>7s} {:>9s} {:>9s} {:>9s} {:>9s}'.format(
+                'stage', 'count', 'mean', 'p50', 'p95', 'max')]
+            for stage, h in sorted(self.histograms.items()):
+                lines.append('{:30s} {:7d} {:8.3f}s {:8.3f}s {:8.3f}s {:8.3f}s'.format(
+                    stage, h.count, h.sum / h.count, h.quantile(0.5), h.quantile(0.95), h.max))
+            return '\n'.join(lines)
+
+    def prometheus_text(self):
+        self.collect()
+        lines = ['# HELP autodj_stage_seconds Time spent per stage of the DJ engine and the annotation.',
+                 '# TYPE autodj_stage_seconds histogram']
+        with self.lock:
+            for stage, h in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(h.buckets, h.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == math.inf else repr(float(bound))
+                    lines.append('autodj_stage_seconds_bucket{{stage="{}",le="{}"}} {}'.format(stage, le, cumulative))
+                lines.append('autodj_stage_seconds_sum{{stage="{}"}} {}'.format(stage, h.sum))
+                lines.append('autodj_stage_seconds_count{{stage="{}"}} {}'.format(stage, h.count))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.prometheus_text())
+        os.replace(tmp_path, path)
+
+    def start_export(self, path=METRICS_FILE, port=METRICS_PORT, interval=METRICS_EXPORT_INTERVAL):
+        """
+        Exports the histograms in the Prometheus text format: rewritten to a file every interval seconds if path is
+        set, and served over HTTP on localhost if port is set.
+        """
+        if path:
+            def export_loop():
+                while True:
+                    try:
+                        self.write_prometheus(path)
+                    except OSError as e:
+                        logger.warning('Could not write metrics to {}: {}'.format(path, e))
+                    time.sleep(interval)
+
+            threading.Thread(target=export_loop, daemon=True).start()
+
+        if port:
+            registry = self
+
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    body = registry.prometheus_text().encode()
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, *args):
+                    pass
+
+            server = HTTPServer(('127.0.0.1', port), Handler)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+
+
+# Process wide registry
+metrics = Metrics()
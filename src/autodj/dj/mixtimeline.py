@@ -0,0 +1,112 @@
+import bisect
+import logging
+
+import numpy as np
+
+logger = logging.getLogger('colorlogger')
+
+
+class MixTimeline:
+    """
+    Ring buffer holding the rendered part of the mix that has not been queued for playback yet, together with a sorted
+    index of the tracklist events (song in, switch, out). Audio and events are addressed in absolute samples since the
+    start of the mix, so nothing has to be rebased when a new song is added.
+
+    Everything before the read position has been handed to the player and its space is reused, so memory stays
+    constant over a session. The capacity is only increased if a single song region does not fit in the buffer.
+    """
+
+    def __init__(self, capacity, num_channels=None):
+        self.channel_shape = () if num_channels is None else (num_channels,)
+        self.buffer = np.zeros(self.channel_shape + (capacity,), dtype='float32')
+        self.read_pos = 0
+        self.write_end = 0
+        self.events = []
+        self.event_idx = 0
+
+    @property
+    def capacity(self):
+        return self.buffer.shape[-1]
+
+    def _ring_slices(self, start, end):
+        """
+        Yields (ring_start, ring_end, offset) for the at most two contiguous parts of [start, end) in the ring.
+        """
+        offset = 0
+        while start < end:
+            ring_start = start % self.capacity
+            length = min(end - start, self.capacity - ring_start)
+            yield ring_start, ring_start + length, offset
+            start += length
+            offset += length
+
+    def _reserve(self, end):
+        if end - self.read_pos <= self.capacity:
+            return
+        new_capacity = max(2 * self.capacity, end - self.read_pos)
+        logger.warning('Mix timeline too small for song region, growing from {} to {} samples'.format(
+            self.capacity, new_capacity))
+        live_audio = self.read(self.read_pos, self.write_end)
+        self.buffer = np.zeros(self.channel_shape + (new_capacity,), dtype='float32')
+        self._copy_in(self.read_pos, live_audio)
+
+    def _copy_in(self, start, audio):
+        for ring_start, ring_end, offset in self._ring_slices(start, start + audio.shape[-1]):
+            self.buffer[..., ring_start:ring_end] = audio[..., offset:offset + ring_end - ring_start]
+
+    def write(self, start, audio):
+        """
+        Writes audio at absolute sample start. The timeline then ends at the end of audio; anything previously
+        rendered after start is discarded.
+        """
+        if start < self.read_pos:
+            raise Exception('Cannot write before the read position of the mix timeline')
+        end = start + audio.shape[-1]
+        self._reserve(end)
+        if start > self.write_end:
+            self._copy_in(self.write_end, np.zeros(self.channel_shape + (start - self.write_end,), dtype='float32'))
+        self._copy_in(start, audio)
+        self.write_end = end
+
+    def read(self, start, end):
+        """
+        Returns a contiguous copy of the audio between absolute samples start and end.
+        """
+        if start < self.read_pos or end > self.write_end:
+            raise Exception('Samples {}-{} are not in the mix timeline ({}-{})'.format(
+                start, end, self.read_pos, self.write_end))
+        out = np.empty(self.channel_shape + (max(0, end - start),), dtype='float32')
+        for ring_start, ring_end, offset in self._ring_slices(start, end):
+            out[..., offset:offset + ring_end - ring_start] = self.buffer[..., ring_start:ring_end]
+        return out
+
+    def consume(self, end):
+        """
+        Marks all audio before absolute sample end as played, so its space can be reused.
+        """
+        self.read_pos = max(self.read_pos, min(end, self.write_end))
+
+    def reset(self, start):
+        """
+        Discards all rendered audio and pending events, and restarts the timeline at absolute sample start.
+        """
+        self.read_pos = self.write_end = start
+        self.events = []
+        self.event_idx = 0
+
+    def add_event(self, sample, *event):
+        bisect.insort(self.events, (sample,) + event, lo=self.event_idx)
+
+    def pop_events(self, until):
+        """
+        Returns the pending events at or before absolute sample until, in order, and removes them from the index.
+        """
+        end_idx = self.event_idx
+        while end_idx < len(self.events) and self.events[end_idx][0] <= until:
+            end_idx += 1
+        result = self.events[self.event_idx:end_idx]
+        self.event_idx = end_idx
+        if self.event_idx > 64:
+            del self.events[:self.event_idx]
+            self.event_idx = 0
+        return result
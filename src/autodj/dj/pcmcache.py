@@ -0,0 +1,98 @@
+import hashlib
+import logging
+import os
+import tempfile
+
+import numpy as np
+
+logger = logging.getLogger('colorlogger')
+
+PCM_CACHE_DIR = os.environ.get('AUTODJ_PCM_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'autodj', 'pcm'))
+PCM_CACHE_MAX_BYTES = int(float(os.environ.get('AUTODJ_PCM_CACHE_MAX_GB', 10)) * 1024 ** 3)
+
+_digests = {}
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """
+    SHA-1 of the contents of a file. Digests are remembered per (path, mtime, size) within a process.
+    """
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    if memo_key not in _digests:
+        sha = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                sha.update(chunk)
+        _digests[memo_key] = sha.hexdigest()
+    return _digests[memo_key]
+
+
+class PcmCache:
+    """
+    On-disk cache of decoded audio. Entries are .npy files named after the SHA-1 of the source file contents and the
+    decoding parameters, so they are shared between processes and between copies of a file in different directories.
+    Entries are memory mapped read-only when loaded. When the cache grows beyond max_bytes, the least recently used
+    entries are removed.
+    """
+
+    def __init__(self, directory=PCM_CACHE_DIR, max_bytes=PCM_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def key(self, path, *params):
+        return '_'.join([file_digest(path)] + [str(p) for p in params])
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npy')
+
+    def load(self, key):
+        path = self._path(key)
+        try:
+            audio = np.load(path, mmap_mode='r')
+        except (FileNotFoundError, ValueError):
+            return None
+        try:
+            os.utime(path)  # Mark as recently used
+        except OSError:
+            pass
+        return audio
+
+    def store(self, key, audio):
+        tmp_path = None
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, audio)
+            # Atomic, so other processes never see a partially written entry
+            os.replace(tmp_path, self._path(key))
+        except OSError as e:
+            logger.warning('Could not write PCM cache entry {}: {}'.format(key, e))
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.npy'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            logger.debug('Evicting PCM cache entry ' + path)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
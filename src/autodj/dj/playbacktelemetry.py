@@ -0,0 +1,95 @@
+import ctypes
+import logging
+import multiprocessing
+
+logger = logging.getLogger('colorlogger')
+
+SAMPLE_RATE = 44100
+# A warning is logged when less audio than this is buffered ahead of the player
+BUFFER_WARNING_SECONDS = 5.0
+
+
+class PlaybackTelemetry:
+    """
+    Counters shared between the DJ process, the player process and the main process that tell how close playback
+    came to running dry. The buffered audio is the audio in the player queue plus what is left of the segment that is
+    being played. It is also the time to starvation: how long playback can continue if no more audio is rendered.
+
+    The DJ process calls add_queued() for every segment it queues. The player calls start_segment() when it takes a
+    segment from the queue, played() for every frame it writes, and underflow() and starved() when the output ran
+    dry. The lowest buffer level of the session is kept together with the song that was playing at the time.
+    """
+
+    def __init__(self, warning_seconds=BUFFER_WARNING_SECONDS):
+        self.warning_samples = int(warning_seconds * SAMPLE_RATE)
+        self.queued_samples = multiprocessing.Value('q', 0)
+        self.segment_samples_left = multiprocessing.Value('q', 0)
+        self.min_buffered_samples = multiprocessing.Value('q', -1)
+        self.num_underflows = multiprocessing.Value('i', 0)
+        self.num_starvations = multiprocessing.Value('i', 0)
+        self.is_low = multiprocessing.Value('b', False)
+        self.num_skips = multiprocessing.Value('i', 0)
+        self.last_skip_seconds = multiprocessing.Value('d', 0.0)
+        self.min_buffered_title = multiprocessing.Manager().Value(ctypes.c_char_p, '')
+
+    def reset(self):
+        for value in (self.queued_samples, self.segment_samples_left, self.num_underflows, self.num_starvations,
+                      self.num_skips):
+            value.value = 0
+        self.min_buffered_samples.value = -1
+        self.is_low.value = False
+        self.min_buffered_title.value = ''
+
+    def buffered_samples(self):
+        return self.queued_samples.value + self.segment_samples_left.value
+
+    def add_queued(self, num_samples):
+        with self.queued_samples.get_lock():
+            self.queued_samples.value += num_samples
+
+    def start_segment(self, num_samples):
+        with self.queued_samples.get_lock():
+            self.queued_samples.value -= num_samples
+        self.segment_samples_left.value = num_samples
+
+    def end_segment(self):
+        self.segment_samples_left.value = 0
+
+    def played(self, num_samples, title):
+        self.segment_samples_left.value -= num_samples
+        buffered = self.buffered_samples()
+        if self.min_buffered_samples.value < 0 or buffered < self.min_buffered_samples.value:
+            self.min_buffered_samples.value = buffered
+            self.min_buffered_title.value = title
+        if buffered < self.warning_samples and not self.is_low.value:
+            self.is_low.value = True
+            logger.warning('Playback buffer low: {:.1f} s left while playing {}'.format(
+                buffered / SAMPLE_RATE, title))
+        elif buffered >= 2 * self.warning_samples and self.is_low.value:
+            self.is_low.value = False
+
+    def underflow(self, title):
+        self.num_underflows.value += 1
+        logger.warning('Audio output underflow #{} while playing {}'.format(self.num_underflows.value, title))
+
+    def starved(self, title):
+        self.num_starvations.value += 1
+        logger.warning('Player queue ran empty after {}'.format(title))
+
+    def skipped(self, seconds, title):
+        self.num_skips.value += 1
+        self.last_skip_seconds.value = seconds
+        logger.info('Skipped to {} in {:.1f} s'.format(title, seconds))
+
+    def report(self):
+        min_buffered = self.min_buffered_samples.value
+        lines = [
+            'Buffered audio (time to starvation): {:.1f} s'.format(self.buffered_samples() / SAMPLE_RATE),
+            'Lowest buffer this session: ' + ('-' if min_buffered < 0 else '{:.1f} s while playing {}'.format(
+                min_buffered / SAMPLE_RATE, self.min_buffered_title.value)),
+            'Output underflows: {}'.format(self.num_underflows.value),
+            'Times the player queue ran empty: {}'.format(self.num_starvations.value),
+            'Skips to a new song: {}'.format(self.num_skips.value) + (' (the last one took {:.1f} s)'.format(
+                self.last_skip_seconds.value) if self.num_skips.value else ''),
+        ]
+        return '\n'.join(lines)
@@ -0,0 +1,145 @@
+import collections
+import datetime
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+logger = logging.getLogger('colorlogger')
+
+PROFILE_DIR = os.environ.get('AUTODJ_PROFILE_DIR', '.')
+SAMPLE_INTERVAL = 0.01
+WATCH_INTERVAL = 0.2
+NUM_ALLOCATION_SITES = 50
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler for all threads of the current process. A background thread samples the Python stacks of the
+    other threads every interval seconds and counts how often each stack is seen. The result is written in the folded
+    stack format, one 'thread;outer frame;...;inner frame count' line per stack, which flame graph tools such as
+    flamegraph.pl or speedscope read directly. Optionally, allocations are traced with tracemalloc during the same
+    period and the largest allocation sites that are still live at the end are written as well.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.num_samples = 0
+        self.trace_allocations = False
+        self.running = threading.Event()
+        self.thread = None
+
+    def start(self, trace_allocations=False):
+        self.stacks.clear()
+        self.num_samples = 0
+        self.trace_allocations = trace_allocations
+        if trace_allocations:
+            tracemalloc.start(16)
+        self.running.set()
+        self.thread = threading.Thread(target=self._sample_loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running.clear()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _sample_loop(self):
+        own_ident = threading.get_ident()
+        while self.running.is_set():
+            thread_names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), frame.f_lineno))
+                    frame = frame.f_back
+                stack.append(thread_names.get(ident, str(ident)))
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.num_samples += 1
+            time.sleep(self.interval)
+
+    def write(self, path_prefix):
+        """
+        Writes path_prefix.folded and, if allocations were traced, path_prefix.alloc.txt. Stops tracing allocations.
+        """
+        with open(path_prefix + '.folded', 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write('{} {}\n'.format(stack, count))
+
+        if self.trace_allocations and tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            current_bytes, peak_bytes = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            with open(path_prefix + '.alloc.txt', 'w') as f:
+                f.write('Traced memory: {:.1f} MB live, {:.1f} MB peak\n\n'.format(
+                    current_bytes / 1024 ** 2, peak_bytes / 1024 ** 2))
+                for stat in snapshot.statistics('traceback')[:NUM_ALLOCATION_SITES]:
+                    f.write('{:.1f} KB in {} blocks\n'.format(stat.size / 1024, stat.count))
+                    for line in stat.traceback.format(most_recent_first=True):
+                        f.write(line + '\n')
+                    f.write('\n')
+
+
+class ProfileControl:
+    """
+    Switches profiling on and off in several processes at once. The control is created in the main process and
+    passed to the subprocesses, each of which calls watch() once. A profiling session is identified by its start
+    time, which is also used in the names of the profile files, so the files of all processes of one session are
+    written side by side as profile_<start time>_<process name>_<pid>.folded.
+    """
+
+    def __init__(self, directory=PROFILE_DIR):
+        self.directory = directory
+        self.session = multiprocessing.Value('d', 0.0)  # Start time of the active session, 0 when not profiling
+        self.trace_allocations = multiprocessing.Value('b', False)
+
+    def start(self, trace_allocations=False):
+        if self.session.value:
+            raise Exception('Profiling is already running!')
+        self.trace_allocations.value = trace_allocations
+        self.session.value = time.time()
+
+    def stop(self):
+        if not self.session.value:
+            raise Exception('Profiling is not running!')
+        session_start = self.session.value
+        self.session.value = 0.0
+        return self.path_prefix(session_start, '*', '*')
+
+    def path_prefix(self, session_start, process_name, pid):
+        timestamp = datetime.datetime.fromtimestamp(session_start).strftime('%Y%m%d-%H%M%S')
+        return os.path.join(self.directory, 'profile_{}_{}_{}'.format(timestamp, process_name, pid))
+
+    def watch(self, process_name):
+        """
+        Starts a thread in the calling process that starts and stops its profiler together with the sessions.
+        """
+        threading.Thread(target=self._watch_loop, args=(process_name,), daemon=True).start()
+
+    def _watch_loop(self, process_name):
+        profiler = SamplingProfiler()
+        active_session = 0.0
+        while True:
+            session = self.session.value
+            if session != active_session:
+                if active_session:
+                    profiler.stop()
+                    path_prefix = self.path_prefix(active_session, process_name, os.getpid())
+                    try:
+                        profiler.write(path_prefix)
+                        logger.debug('Profile of {} written to {}.folded ({} samples)'.format(
+                            process_name, path_prefix, profiler.num_samples))
+                    except OSError as e:
+                        logger.warning('Could not write profile of {}: {}'.format(process_name, e))
+                if session:
+                    profiler.start(bool(self.trace_allocations.value))
+                active_session = session
+            time.sleep(WATCH_INTERVAL)
@@ -0,0 +1,64 @@
+import collections
+import logging
+import os
+import threading
+
+logger = logging.getLogger('colorlogger')
+
+SONG_MEMORY_BUDGET = int(float(os.environ.get('AUTODJ_SONG_MEMORY_MB', 4096)) * 1024 ** 2)
+
+
+class SongResidency:
+    """
+    Keeps the audio held by the songs of a process within a memory budget. A song is touched whenever its audio is
+    used. When all songs together hold more than max_bytes, the least recently used ones are compacted first (see
+    Song.compact()), and released if that is not enough; released audio is loaded again when it is used. The most
+    recently used song is never evicted, so a single song larger than the budget still works.
+    """
+
+    def __init__(self, max_bytes=SONG_MEMORY_BUDGET):
+        self.max_bytes = max_bytes
+        self.songs = collections.OrderedDict()  # Least recently used first
+        self.lock = threading.RLock()
+        self.is_evicting = False
+
+    def touch(self, song):
+        with self.lock:
+            self.songs[id(song)] = song
+            self.songs.move_to_end(id(song))
+            if not self.is_evicting:
+                self._evict()
+
+    def forget(self, song):
+        with self.lock:
+            self.songs.pop(id(song), None)
+
+    def resident_bytes(self):
+        with self.lock:
+            return sum(song.audio_bytes() for song in self.songs.values())
+
+    def _evict(self):
+        total_bytes = self.resident_bytes()
+        if total_bytes <= self.max_bytes:
+            return
+        self.is_evicting = True
+        try:
+            for evict in ('compact', 'releaseAudio'):
+                for song in list(self.songs.values())[:-1]:
+                    if total_bytes <= self.max_bytes:
+                        return
+                    song_bytes = song.audio_bytes()
+                    getattr(song, evict)()
+                    total_bytes -= song_bytes - song.audio_bytes()
+                    logger.debug('{} {} to stay within the song memory budget'.format(
+                        'Compacted' if evict == 'compact' else 'Released', song.title))
+        finally:
+            self.is_evicting = False
+
+    def report(self):
+        with self.lock:
+            return 'Audio of {} songs in memory: {:.0f} MB of {:.0f} MB'.format(
+                len(self.songs), self.resident_bytes() / 1024 ** 2, self.max_bytes / 1024 ** 2)
+
+
+song_residency = SongResidency()
@@ -1,11 +1,23 @@
+import functools
 import json
+import logging
+import os
+import tempfile
+import time
+
+import numpy as np
 
 from .annotators.wrappers import *
-from .timestretching import *
+from .metrics import metrics
+from .pcmcache import PcmCache, PCM_CACHE_DIR, file_digest
+from .residency import song_residency
 from ..annotation.util import *
 
 logger = logging.getLogger('colorlogger')
 
+# Shared cache of decoded audio; disabled by setting AUTODJ_PCM_CACHE to an empty string
+pcm_cache = PcmCache() if PCM_CACHE_DIR else None
+
 
 def normalizeAudioGain(audio, rgain, target=-10):
     factor = 10 ** ((-(target - rgain) / 10) / 2)
@@ -14,26 +26,100 @@ def normalizeAudioGain(audio, rgain, target=-10):
 
 
 class Song:
-    def __init__(self, path_to_file, annotation_modules=None):
+    def __init__(self, path_to_file, annotation_modules=None, annotation_dir=None):
+        """
+        The annotations of the song are stored in the _annot_auto directory next to the audio file, or in
+        annotation_dir if given (used by the annotation shards, see annotationshards.py).
+        """
         self.filepath = path_to_file
         self.dir_, self.title = os.path.split(os.path.abspath(path_to_file))
         self.title, self.extension = os.path.splitext(self.title)
-        self.dir_annot = os.path.join(self.dir_, ANNOT_SUBDIR)
+        self.dir_annot = os.path.join(self.dir_, ANNOT_SUBDIR) if annotation_dir is None else annotation_dir
 
         if not os.path.isdir(self.dir_annot):
             logger.debug('Creating annotation directory : ' + self.dir_annot)
-            os.mkdir(self.dir_annot)
+            os.makedirs(self.dir_annot, exist_ok=True)
 
+        self._audio_compact = None
+        self._audio_loader = None
+        self._audio_decimated = None
+        self.audio_stereo = None
         self.audio = None
+        self.audio_start_sample = 0
 
         self.songBeginPadding = 0
-        self.fft_phase_1024_512 = None
-        self.fft_mag_1024_512 = None
+        self.odfs_1024_512 = None
 
         self.annotation_modules = annotation_modules if annotation_modules is not None else []
         self.json_features = {}
         self.json_file_path = os.path.join(self.dir_annot, f'{self.title}.json')
 
+    @property
+    def audio_stereo(self):
+        """
+        Stereo audio of the song, of shape (2, num_samples). Audio that was compacted or released to stay within the
+        song memory budget is restored when it is used.
+        """
+        if self._audio_stereo is None:
+            if self._audio_compact is not None:
+                compact, scale = self._audio_compact
+                self._audio_compact = None
+                self._audio_stereo = compact.astype('single') * np.single(scale)
+            elif self._audio_loader is not None:
+                self._audio_loader()
+        if self._audio_stereo is not None:
+            song_residency.touch(self)
+        return self._audio_stereo
+
+    @audio_stereo.setter
+    def audio_stereo(self, audio):
+        self._audio_stereo = audio
+        self._audio_compact = None
+        self._audio = None
+        self._audio_decimated = None
+        if audio is None:
+            self._audio_loader = None
+            song_residency.forget(self)
+        else:
+            song_residency.touch(self)
+
+    @property
+    def audio(self):
+        """
+        Mono audio of the song, derived from the stereo audio on first use.
+        """
+        if self._audio is None:
+            audio_stereo = self.audio_stereo
+            if audio_stereo is not None:
+                import librosa
+                self._audio = librosa.to_mono(np.asarray(audio_stereo))
+        else:
+            song_residency.touch(self)
+        return self._audio
+
+    @audio.setter
+    def audio(self, audio):
+        self._audio = audio
+        self._audio_decimated = None
+
+    def decimated_audio(self, factor):
+        """
+        Mono audio of the song at 1 / factor of its sample rate, for the annotation modules that analyse it at a lower
+        rate. It is derived on first use and kept until the audio changes.
+        """
+        if self._audio_decimated is None or self._audio_decimated[0] != factor:
+            from .timestretching import resample_poly_blocks
+            self._audio_decimated = (factor, resample_poly_blocks(self.audio, 1, factor))
+        return self._audio_decimated[1]
+
+    @property
+    def audio_left(self):
+        return None if self.audio_stereo is None else self.audio_stereo[0]
+
+    @property
+    def audio_right(self):
+        return None if self.audio_stereo is None else self.audio_stereo[1]
+
     def _add_features_to_song(self, dict_):
         for k, v in dict_.items():
             setattr(self, k, v)
@@ -56,34 +142,20 @@ class Song:
         return True
 
     def annotate(self):
-        loader = MonoLoader(filename=os.path.join(self.dir_, self.title + self.extension))
-        self.audio = loader()
-        self.open()
-        for annot_module_wrapper in self.annotation_modules:
-            if not annot_module_wrapper.is_annotated_in(self):
-                logger.debug(f'Calculating {annot_module_wrapper} annotations of {self.title}')
-                calculated_features = annot_module_wrapper.process(self)
-                self._add_features_to_song(calculated_features)
-                additional_features = annot_module_wrapper.calculate_supplimentary_features(self)
-                self._add_features_to_song(additional_features)
-
-                try:
-                    annot_module_wrapper.save_annotations_to_file(self, self.dir_annot)
-                except NotImplementedError:
-                    self.json_features.update(calculated_features)
-
-            else:
-                additional_features = annot_module_wrapper.calculate_supplimentary_features(self)
-                self._add_features_to_song(additional_features)
-
-        self._save_json_features(self.json_features, self.json_file_path)
-        self.json_features = None
-
-        self.close()
+        annotate_songs([self])
 
     def _save_json_features(self, data, path_to_file):
-        with open(path_to_file, 'w+') as jsonfile:
-            json.dump(data, jsonfile)
+        # Written to a temporary file that replaces the old one, so an interrupted write never loses annotations
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path_to_file), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as jsonfile:
+                json.dump(data, jsonfile)
+                jsonfile.flush()
+                os.fsync(jsonfile.fileno())
+            os.replace(tmp_path, path_to_file)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
 
     def _load_json_features(self, path_to_file):
         with open(path_to_file, 'r+') as jsonfile:
@@ -96,7 +168,7 @@ class Song:
             self._add_features_to_song(self.json_features)
         except FileNotFoundError as e:
             print(e)
-            pass
+            self.json_features = {}
 
         for annot_module_wrapper in self.annotation_modules:
             if annot_module_wrapper.is_annotated_in(self):
@@ -109,21 +181,110 @@ class Song:
                 additional_features = annot_module_wrapper.calculate_supplimentary_features(self)
                 self._add_features_to_song(additional_features)
 
-    def openAudio(self):
+    def _loadPcm(self, file_start=0, file_end=None):
+        """
+        Decodes the audio between the given samples of the audio file into the representation shared by annotation
+        and playback: 44.1 kHz float32 stereo of shape (2, num_samples), without gain normalisation. A cached full
+        decode is sliced if available (read-only). Otherwise the whole file is decoded and cached, so that songs played
+        from a range are not decoded again either; only without a cache is just the requested range decoded, seeking
+        to its start.
+        """
         filename = os.path.join(self.dir_, self.title + self.extension)
-        audio, sr = librosa.load(filename, sr=44100, mono=False)
-        audio = audio.astype('single')
-        self.audio_left, self.audio_right = audio[0, :], audio[1, :]
-        self.audio = librosa.to_mono(audio)
-        self.audio = normalizeAudioGain(self.audio, self.replaygain)
-        if self.songBeginPadding > 0:
-            self.audio = np.append(np.zeros((1, self.songBeginPadding), dtype='single'), self.audio)
+        audio = None
+        if pcm_cache is not None:
+            cache_key = pcm_cache.key(filename, 44100)
+            audio = pcm_cache.load(cache_key)
+        if audio is not None:
+            return audio[:, file_start:file_end]
+
+        import librosa
+        offset, duration = 0.0, None
+        if pcm_cache is None:
+            offset = file_start / 44100.0
+            duration = None if file_end is None else (file_end - file_start) / 44100.0
+        audio, sr = librosa.load(filename, sr=44100, mono=False, offset=offset, duration=duration)
+        audio = np.atleast_2d(audio).astype('single', copy=False)
+        if audio.shape[0] == 1:
+            audio = np.concatenate((audio, audio))
+        if pcm_cache is not None:
+            pcm_cache.store(cache_key, audio)
+            if file_start > 0 or file_end is not None:
+                # A copy, so the rest of the song is not kept in memory
+                audio = np.array(audio[:, file_start:file_end])
+        return audio
+
+    def openRawAudio(self):
+        """
+        Loads the entire song as decoded, without begin padding and gain normalisation, as it is annotated.
+        """
+        self.audio_stereo = self._loadPcm()
+        self._audio_loader = self.openRawAudio
+
+    def openAudio(self, start_sample=0, end_sample=None):
+        """
+        Loads the audio of the song between the given samples (counted including the begin padding of the song), or
+        the entire song by default. audio_start_sample is the index of the first loaded sample within the song.
+        """
+        padding = self.songBeginPadding
+        file_start = max(0, start_sample - padding)
+        file_end = None if end_sample is None else max(file_start, end_sample - padding)
+        audio = self._loadPcm(file_start, file_end)
+        if not audio.flags.writeable:
+            audio = np.array(audio)
+        audio = normalizeAudioGain(audio, self.replaygain)
+
+        num_padding_samples = max(0, min(padding, end_sample if end_sample is not None else padding) - start_sample)
+        if num_padding_samples > 0:
+            audio = np.concatenate((np.zeros((audio.shape[0], num_padding_samples), dtype='single'), audio), axis=1)
+        self.audio_start_sample = start_sample
+        self.audio_stereo = audio
+        self._audio_loader = functools.partial(self.openAudio, start_sample, end_sample)
 
     def closeAudio(self):
-        self.audio = None
+        self.audio_stereo = None
+
+    def audio_bytes(self):
+        """
+        Memory held by the audio of the song. Audio memory mapped from the decoded audio cache is not counted, since it
+        can be reloaded at no cost.
+        """
+        arrays = [self._audio]
+        if self._audio_decimated is not None:
+            arrays.append(self._audio_decimated[1])
+        if self._audio_stereo is not None and self._audio_stereo.flags.writeable:
+            arrays.append(self._audio_stereo)
+        if self._audio_compact is not None:
+            arrays.append(self._audio_compact[0])
+        return sum(array.nbytes for array in arrays if isinstance(array, np.ndarray))
+
+    def compact(self):
+        """
+        Reduces the memory held by the song without unloading it: the mono and decimated audio are dropped, as they are
+        derived again when needed, and the stereo audio is kept as 16 bit integers.
+        """
+        self._audio = None
+        self._audio_decimated = None
+        audio = self._audio_stereo
+        if audio is None:
+            return
+        self._audio_stereo = None
+        if not audio.flags.writeable and self._audio_loader is not None:
+            return  # Memory mapped, reloading it is cheaper than a copy
+        scale = max(float(np.max(np.abs(audio))), 1e-9) / 32767
+        self._audio_compact = (np.round(audio / np.single(scale)).astype(np.int16), scale)
+
+    def releaseAudio(self):
+        """
+        Frees the audio of the song, which is loaded again when it is used. Audio that cannot be loaded again, since it
+        was not loaded by openAudio() or openRawAudio(), is only compacted.
+        """
+        self.compact()
+        if self._audio_loader is not None:
+            self._audio_compact = None
+            song_residency.forget(self)
 
     def close(self):
-        self.audio = None
+        self.audio_stereo = None
         self.beats = None
         self.onset_curve = None
         self.tempo = None
@@ -134,8 +295,7 @@ class Song:
         self.key = None
         self.scale = None
         self.spectralContrast = None
-        self.fft_phase_1024_512 = None
-        self.fft_mag_1024_512 = None
+        self.odfs_1024_512 = None
 
     def getOnsetCurveFragment(self, start_beat_idx, stop_beat_idx):
         HOP_SIZE = 512
@@ -152,3 +312,54 @@ class Song:
 
     def unmarkForAnnotation(self):
         deleteCsvAnnotation(self.dir_, ANNOT_MARKED_PREFIX, self.title)
+
+
+def annotate_songs(songs):
+    """
+    Annotates several songs together. Each annotation module runs on all songs that still need it before the next
+    module starts, so the model based modules classify the features of all songs in one batch. The annotation file of
+    a song is rewritten as soon as a module has finished, so an interrupted annotation resumes from the first module
+    that did not finish.
+    """
+    try:
+        for song in songs:
+            song.openRawAudio()
+            song.open()
+            # Saved with the annotations, so they are kept if the file is touched without changing its contents
+            song.json_features['audio_digest'] = file_digest(song.filepath)
+
+        for annot_module_wrapper in songs[0].annotation_modules:
+            songs_to_annotate = []
+            for song in songs:
+                if annot_module_wrapper.is_annotated_in(song):
+                    song._add_features_to_song(annot_module_wrapper.calculate_supplimentary_features(song))
+                else:
+                    songs_to_annotate.append(song)
+            if len(songs_to_annotate) == 0:
+                continue
+
+            logger.debug(f'Calculating {annot_module_wrapper} annotations of {len(songs_to_annotate)} songs')
+            start = time.perf_counter()
+            all_calculated_features = annot_module_wrapper.process_batch(songs_to_annotate)
+            seconds_per_song = (time.perf_counter() - start) / len(songs_to_annotate)
+
+            for song, calculated_features in zip(songs_to_annotate, all_calculated_features):
+                metrics.observe('annotate.' + type(annot_module_wrapper).__name__, seconds_per_song)
+                song._add_features_to_song(calculated_features)
+                additional_features = annot_module_wrapper.calculate_supplimentary_features(song)
+                song._add_features_to_song(additional_features)
+
+                try:
+                    annot_module_wrapper.save_annotations_to_file(song, song.dir_annot)
+                except NotImplementedError:
+                    song.json_features.update(calculated_features)
+                    song._save_json_features(song.json_features, song.json_file_path)
+    except BaseException:
+        # close() would make the songs look annotated, since it sets all features to None
+        for song in songs:
+            song.json_features = None
+            song.closeAudio()
+        raise
+    for song in songs:
+        song.json_features = None
+        song.close()
@@ -1,8 +1,22 @@
+import json
+import tempfile
+import threading
+
 from . import song
+from .annotationmanifest import AnnotationManifest, import_shards
+from .annotators.wrappers import ANNOTATION_PROFILE
+from .pcmcache import file_digest
 from ..annotation.util import *
 
 logger = logging.getLogger('colorlogger')
 
+# Songs annotated together, so the models run on the features of all of them at once. All their audio is held in
+# memory meanwhile.
+ANNOTATION_BATCH_SIZE = 8
+MANIFEST_FILE = 'manifest.json'
+# Suffix of the annotation files of songs whose audio file has changed since they were annotated
+STALE_SUFFIX = '.stale'
+
 circle_of_fifths = {
     'major': ['C', 'G', 'D', 'A', 'E', 'B', 'F#', 'C#', 'Ab', 'Eb', 'Bb', 'F'],
     'minor': ['A', 'E', 'B', 'F#', 'C#', 'Ab', 'Eb', 'Bb', 'F', 'C', 'G', 'D']
@@ -57,6 +71,11 @@ class SongCollection:
         self.directories = []
         self.key_title = {}
         self.annotation_modules = annotation_modules
+        # Per directory: {file name: [mtime_ns, size]} of the audio files the songs were loaded from
+        self.manifests = {}
+        # Modification times of the annotation files of unannotated songs when they were last checked
+        self.annotation_mtimes = {}
+        self.lock = threading.RLock()
 
     def init_key_title_map(self):
         self.key_title = {}
@@ -73,30 +92,249 @@ class SongCollection:
         if len(self.key_title) == 0:
             logger.warning("Key-title map is empty!")
 
+    def add_to_key_title_map(self, s):
+        if s.hasAllAnnot():
+            self.key_title.setdefault(s.key, []).append(s.title)
+
+    def remove_from_key_title_map(self, s):
+        for titles in self.key_title.values():
+            if s.title in titles:
+                titles.remove(s.title)
+
     def clear(self):
         self.songs = []
         self.directories = []
         self.key_title = []
+        self.manifests = {}
+
+    @staticmethod
+    def _scan_directory(directory_):
+        manifest = {}
+        with os.scandir(directory_) as entries:
+            for entry in entries:
+                if entry.is_file() and (entry.name.endswith('.wav') or entry.name.endswith('.mp3')):
+                    stat = entry.stat()
+                    manifest[entry.name] = [stat.st_mtime_ns, stat.st_size]
+        return manifest
+
+    @staticmethod
+    def _manifest_path(directory_):
+        return os.path.join(directory_, ANNOT_SUBDIR, MANIFEST_FILE)
+
+    def _save_manifest(self, directory_):
+        path = self._manifest_path(directory_)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # A temporary file of its own, as several processes may rescan the same directory
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.manifests[directory_], f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def _invalidate_annotations(self, directory_, filename):
+        title = os.path.splitext(filename)[0]
+        json_path = os.path.join(directory_, ANNOT_SUBDIR, title + '.json')
+        try:
+            with open(json_path) as f:
+                audio_digest = json.load(f).get('audio_digest')
+        except FileNotFoundError:
+            return
+        except ValueError:
+            audio_digest = None
+        # A file that was only touched or copied over with the same contents keeps its annotations
+        if audio_digest is not None and audio_digest == file_digest(os.path.join(directory_, filename)):
+            return
+        # Moved aside rather than deleted, so annotations of a file that was changed by mistake can be restored
+        logger.info('{} has changed, its annotations are moved to {}'.format(filename, json_path + STALE_SUFFIX))
+        os.replace(json_path, json_path + STALE_SUFFIX)
 
     def load_directory(self, directory):
         directory_ = os.path.abspath(directory)
-        if directory_ in self.directories:
-            return
-        logger.info('Loading directory ' + directory + '...')
-        self.directories.append(directory_)
-        self.songs.extend([
-            song.Song(os.path.join(directory_, f), annotation_modules=self.annotation_modules)
-            for f in os.listdir(directory_)
-            if os.path.isfile(os.path.join(directory_, f)) and (f.endswith('.wav') or f.endswith('.mp3'))
-        ])
-        for s in self.songs:
-            s.open()
-        self.init_key_title_map()
+        with self.lock:
+            if directory_ in self.directories:
+                self.rescan(directory_)
+                return
+            logger.info('Loading directory ' + directory + '...')
+            manifest = self._scan_directory(directory_)
+
+            # Files that changed since the directory was last loaded have to be annotated again
+            try:
+                with open(self._manifest_path(directory_)) as f:
+                    stored_manifest = json.load(f)
+                for filename, stat in manifest.items():
+                    if filename in stored_manifest and stored_manifest[filename] != stat:
+                        self._invalidate_annotations(directory_, filename)
+            except (FileNotFoundError, ValueError):
+                pass
 
-    def annotate(self):
+            self.directories.append(directory_)
+            self.manifests[directory_] = manifest
+            self.update_songs([os.path.join(directory_, f) for f in sorted(manifest)], [])
+            self._save_manifest(directory_)
+
+    def rescan(self, directory=None):
+        """
+        Compares the loaded directories (or only the given one) with the files currently in them. Songs of new files
+        are added, songs of deleted files are removed, and files that were modified since they were loaded are
+        loaded again without their outdated annotations. Songs that were annotated by another process, such as the
+        annotation daemon, are loaded again with their annotations. Returns the paths of the added and the removed
+        files; a modified or reloaded file appears in both.
+        """
+        with self.lock:
+            directories = self.directories if directory is None else [os.path.abspath(directory)]
+            added_paths, removed_paths = [], []
+            for directory_ in directories:
+                previous = self.manifests[directory_]
+                current = self._scan_directory(directory_)
+                if current == previous:
+                    continue
+                for filename in previous:
+                    if filename not in current or current[filename] != previous[filename]:
+                        removed_paths.append(os.path.join(directory_, filename))
+                for filename in current:
+                    if filename not in previous or current[filename] != previous[filename]:
+                        if filename in previous:
+                            self._invalidate_annotations(directory_, filename)
+                        added_paths.append(os.path.join(directory_, filename))
+                self.manifests[directory_] = current
+                self._save_manifest(directory_)
+            for path in self._annotated_elsewhere(directories):
+                if path not in added_paths:
+                    added_paths.append(path)
+                    removed_paths.append(path)
+            if added_paths or removed_paths:
+                self.update_songs(added_paths, removed_paths)
+            return added_paths, removed_paths
+
+    def _annotated_elsewhere(self, directories):
+        paths = []
         for s in self.get_unannotated():
-            s.annotate()
-        self.init_key_title_map()
+            if os.path.dirname(os.path.abspath(s.filepath)) not in directories:
+                continue
+            try:
+                mtime = os.stat(s.json_file_path).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            # Only songs whose annotation file changed since the last check are opened
+            if self.annotation_mtimes.get(s.filepath) != mtime:
+                self.annotation_mtimes[s.filepath] = mtime
+                reloaded = song.Song(s.filepath, annotation_modules=self.annotation_modules)
+                reloaded.open()
+                if reloaded.hasAllAnnot():
+                    paths.append(s.filepath)
+        return paths
+
+    def update_songs(self, added_paths, removed_paths):
+        """
+        Removes the songs of removed_paths and adds songs for added_paths, updating the key-title map. Returns the
+        added and the removed songs.
+        """
+        with self.lock:
+            removed_paths = set(removed_paths)
+            removed_songs = [s for s in self.songs if s.filepath in removed_paths]
+            for s in removed_songs:
+                self.remove_from_key_title_map(s)
+            self.songs = [s for s in self.songs if s.filepath not in removed_paths]
+
+            added_songs = [song.Song(path, annotation_modules=self.annotation_modules) for path in added_paths]
+            for s in added_songs:
+                s.open()
+                self.add_to_key_title_map(s)
+            self.songs.extend(added_songs)
+
+            if added_songs or removed_songs:
+                logger.info('{} songs added, {} songs removed [annotated: {}, unannotated: {}]'.format(
+                    len(added_songs), len(removed_songs), len(self.get_annotated()), len(self.get_unannotated())))
+            return added_songs, removed_songs
+
+    def watch(self, interval, on_change=None):
+        """
+        Starts a thread that rescans the loaded directories every interval seconds, until the returned event is set.
+        on_change is called with the added and removed paths of every rescan that found changes.
+        """
+        stopped = threading.Event()
+
+        def watch_loop():
+            while not stopped.wait(interval):
+                try:
+                    added_paths, removed_paths = self.rescan()
+                    if (added_paths or removed_paths) and on_change is not None:
+                        on_change(added_paths, removed_paths)
+                except OSError as e:
+                    logger.warning('Rescanning failed: {}'.format(e))
+
+        threading.Thread(target=watch_loop, daemon=True).start()
+        return stopped
+
+    def annotate(self, batch_size=ANNOTATION_BATCH_SIZE):
+        """
+        Annotates the songs that are not annotated yet and returns them.
+        """
+        with self.lock:
+            unannotated = self.get_unannotated()
+        for i in range(0, len(unannotated), batch_size):
+            song.annotate_songs(unannotated[i:i + batch_size])
+            with self.lock:
+                for s in unannotated[i:i + batch_size]:
+                    if s in self.songs:
+                        self.add_to_key_title_map(s)
+        return unannotated
+
+    def export_annotation_manifest(self, path, profile=ANNOTATION_PROFILE):
+        """
+        Writes a manifest of the songs that are not annotated yet to path, for annotating them in shards on several
+        machines (see annotationshards.py), and returns it.
+        """
+        with self.lock:
+            unannotated = self.get_unannotated()
+            root = os.path.commonpath(self.directories) if self.directories else os.getcwd()
+            songs = []
+            for s in unannotated:
+                directory_, filename = os.path.split(os.path.abspath(s.filepath))
+                songs.append({'path': os.path.relpath(os.path.join(directory_, filename), root),
+                              'stat': self.manifests[directory_][filename]})
+        manifest = AnnotationManifest(root, songs, profile)
+        manifest.save(path)
+        logger.info('Exported a manifest of {} songs to annotate to {}'.format(len(songs), path))
+        return manifest
+
+    def import_annotation_shards(self, manifest, shard_dirs):
+        """
+        Merges the annotations made in the shards of manifest into the collection, and records the version of the audio
+        files they were made for in the manifests of their directories, so they are discarded if the files change.
+        Songs of the loaded directories are loaded again with their annotations. Returns the paths of the merged songs
+        and the conflicts, as (song or shard, reason) tuples, which are not merged.
+        """
+        with self.lock:
+            merged, conflicts = import_shards(manifest, shard_dirs)
+            merged_directories = {}
+            for path, stat in merged:
+                directory_, filename = os.path.split(os.path.abspath(path))
+                merged_directories.setdefault(directory_, {})[filename] = stat
+            for directory_, stats in merged_directories.items():
+                if directory_ not in self.manifests:
+                    try:
+                        with open(self._manifest_path(directory_)) as f:
+                            self.manifests[directory_] = json.load(f)
+                    except (FileNotFoundError, ValueError):
+                        self.manifests[directory_] = {}
+                self.manifests[directory_].update(stats)
+                self._save_manifest(directory_)
+                if directory_ not in self.directories:
+                    del self.manifests[directory_]
+
+            merged_paths = [path for path, _ in merged]
+            loaded_paths = {s.filepath for s in self.songs}
+            reloaded_paths = [path for path in merged_paths if path in loaded_paths]
+            if reloaded_paths:
+                self.update_songs(reloaded_paths, reloaded_paths)
+            for name, reason in conflicts:
+                logger.warning('Not imported {}: {}'.format(name, reason))
+            logger.info('Imported the annotations of {} songs, {} conflicts'.format(len(merged_paths), len(conflicts)))
+            return merged_paths, conflicts
 
     def get_unannotated(self):
         return [s for s in self.songs if not s.hasAllAnnot()]
@@ -1,86 +1,123 @@
 import logging
 
 import numpy as np
-import scipy.signal
-import yodel.filter
 
 from . import tracklister
 
 logger = logging.getLogger('colorlogger')
 
-
-def piecewise_fade_volume(audio, volume_profile, fade_in_len):
-    output_audio = np.zeros(audio.shape)
-    fade_in_len_samples = output_audio.size
-
-    for j in range(len(volume_profile) - 1):
-        start_dbeat, start_volume = volume_profile[j]
-        end_dbeat, end_volume = volume_profile[j + 1]
-        start_idx = int(fade_in_len_samples * float(start_dbeat) / fade_in_len)
-        end_idx = int(fade_in_len_samples * float(end_dbeat) / fade_in_len)
-        audio_to_fade = audio[start_idx:end_idx]
-        output_audio[start_idx:end_idx] = linear_fade_volume(
-            audio_to_fade, start_volume=start_volume, end_volume=end_volume)
-
-    return output_audio
-
-
-def piecewise_lin_fade_filter(audio, filter_type, profile, fade_in_len):
-    output_audio = np.zeros(audio.shape)
-    fade_in_len_samples = audio.size
-
-    for j in range(len(profile) - 1):
-        start_dbeat, start_volume = profile[j]
-        end_dbeat, end_volume = profile[j + 1]
-        start_idx = int(fade_in_len_samples * float(start_dbeat) / fade_in_len)
-        end_idx = int(fade_in_len_samples * float(end_dbeat) / fade_in_len)
-        audio_to_fade = audio[start_idx:end_idx]
-        output_audio[start_idx:end_idx] = linear_fade_filter(audio_to_fade, filter_type, start_volume=start_volume,
-                                                             end_volume=end_volume)
-
-    return output_audio
-
-
-def linear_fade_volume(audio, start_volume=0.0, end_volume=1.0):
-    if start_volume == end_volume == 1.0:
-        return audio
-
-    length = audio.size
-    profile = np.sqrt(np.linspace(start_volume, end_volume, length))
-    return audio * profile
-
-
-def linear_fade_filter(audio, filter_type, start_volume=0.0, end_volume=1.0):
-    if start_volume == end_volume == 1.0:
-        return audio
-
-    SAMPLE_RATE = 44100
-    LOW_CUTOFF = 70
-    HIGH_CUTOFF = 13000
-    Q = 1.0 / np.sqrt(2)
-    NUM_STEPS = 20 if start_volume != end_volume else 1
-
-    bquad_filter = yodel.filter.Biquad()
-    length = audio.size
-
-    profile = np.linspace(start_volume, end_volume, NUM_STEPS)
-    output_audio = np.zeros(audio.shape)
-
-    for i in range(NUM_STEPS):
-        start_idx = int((i / float(NUM_STEPS)) * length)
-        end_idx = int(((i + 1) / float(NUM_STEPS)) * length)
-        if filter_type == 'low_shelf':
-            bquad_filter.low_shelf(SAMPLE_RATE, LOW_CUTOFF, Q, -int(26 * (1.0 - profile[i])))
-        elif filter_type == 'high_shelf':
-            bquad_filter.high_shelf(SAMPLE_RATE, HIGH_CUTOFF, Q, -int(26 * (1.0 - profile[i])))
-        else:
-            raise Exception('Unknown filter type: ' + filter_type)
-        b = bquad_filter._b_coeffs
-        a = bquad_filter._a_coeffs
-        a[0] = 1
-        output_audio[start_idx: end_idx] = scipy.signal.lfilter(b, a, audio[start_idx: end_idx]).astype('float32')
-
-    return output_audio
+SAMPLE_RATE = 44100
+EQ_LOW_CUTOFF = 70
+EQ_HIGH_CUTOFF = 13000
+EQ_Q = 1.0 / np.sqrt(2)
+EQ_MAX_ATTENUATION_DB = 26
+EQ_BLOCK_LEN = 2048
+
+
+def shelf_sos(filter_type, gain_db, sample_rate=SAMPLE_RATE):
+    """
+    Coefficients of the EQ shelf filter (Audio EQ Cookbook, as in yodel.filter.Biquad) for each of the given gains in
+    dB, as an array of second-order sections of shape (len(gain_db), 6).
+    """
+    gain_db = np.asarray(gain_db, dtype='float64')
+    if filter_type == 'low_shelf':
+        cutoff = EQ_LOW_CUTOFF
+    elif filter_type == 'high_shelf':
+        cutoff = EQ_HIGH_CUTOFF
+    else:
+        raise Exception('Unknown filter type: ' + filter_type)
+
+    A = np.power(10, gain_db / 40.0)
+    w0 = 2.0 * np.pi * cutoff / sample_rate
+    cos_w0 = np.cos(w0)
+    sqrt_alpha = 2.0 * np.sqrt(A) * np.sin(w0) / (2.0 * EQ_Q)
+
+    if filter_type == 'low_shelf':
+        b = (A * ((A + 1) - (A - 1) * cos_w0 + sqrt_alpha),
+             2.0 * A * ((A - 1) - (A + 1) * cos_w0),
+             A * ((A + 1) - (A - 1) * cos_w0 - sqrt_alpha))
+        a = ((A + 1) + (A - 1) * cos_w0 + sqrt_alpha,
+             -2.0 * ((A - 1) + (A + 1) * cos_w0),
+             (A + 1) + (A - 1) * cos_w0 - sqrt_alpha)
+    else:
+        b = (A * ((A + 1) + (A - 1) * cos_w0 + sqrt_alpha),
+             -2.0 * A * ((A - 1) + (A + 1) * cos_w0),
+             A * ((A + 1) + (A - 1) * cos_w0 - sqrt_alpha))
+        a = ((A + 1) - (A - 1) * cos_w0 + sqrt_alpha,
+             2.0 * ((A - 1) - (A + 1) * cos_w0),
+             (A + 1) - (A - 1) * cos_w0 - sqrt_alpha)
+
+    sos = np.stack(b + a, axis=-1)
+    return sos / sos[..., 3:4]
+
+
+def _profile_sample_points(profile, len_dbeats, num_samples):
+    return [int(num_samples * float(dbeat) / len_dbeats) for dbeat, _ in profile], [value for _, value in profile]
+
+
+def profile_at_blocks(profile, len_dbeats, num_samples, block_len=EQ_BLOCK_LEN):
+    """
+    Values of a piecewise linear (downbeat, value) profile at the centers of consecutive blocks of block_len samples.
+    """
+    sample_points, values = _profile_sample_points(profile, len_dbeats, num_samples)
+    block_centers = np.minimum(np.arange(0, num_samples, block_len) + block_len / 2, num_samples)
+    return np.interp(block_centers, sample_points, values)
+
+
+def profile_curve(profile, len_dbeats, num_samples):
+    """
+    Values of a piecewise linear (downbeat, value) profile at every sample, as float32.
+    """
+    sample_points, values = _profile_sample_points(profile, len_dbeats, num_samples)
+    return np.interp(np.arange(num_samples, dtype='float32'), sample_points, values).astype('float32')
+
+
+def profile_to_gain_db(values):
+    return -EQ_MAX_ATTENUATION_DB * (1.0 - np.asarray(values))
+
+
+class ShelfEQ:
+    """
+    Cascade of a low shelf and a high shelf filter, applied in one second-order-sections pass over all channels.
+
+    The filter state is kept across blocks and calls, and the shelf gains are updated every block_len samples, so gain
+    changes are smooth and there are no discontinuities at block boundaries. As long as both gains are 0 dB and the
+    filter is at rest, the audio is passed through unfiltered.
+    """
+
+    def __init__(self, block_len=EQ_BLOCK_LEN):
+        self.block_len = block_len
+        self.zi = None
+
+    def reset(self):
+        self.zi = None
+
+    def process(self, audio, low_gain_db, high_gain_db, out=None):
+        """
+        Filters audio of shape (..., num_samples), with one low and one high shelf gain per block. The result is
+        written into out (which may be audio itself) and returned.
+        """
+        from scipy import signal
+        if out is None:
+            out = np.empty(audio.shape, dtype='float32')
+        sos = np.stack((shelf_sos('low_shelf', low_gain_db), shelf_sos('high_shelf', high_gain_db)), axis=1)
+
+        # Consecutive blocks with the same gains are filtered in one call
+        num_blocks = len(low_gain_db)
+        run_starts = [0] + [i for i in range(1, num_blocks)
+                            if low_gain_db[i] != low_gain_db[i - 1] or high_gain_db[i] != high_gain_db[i - 1]]
+
+        for run_start, run_end in zip(run_starts, run_starts[1:] + [num_blocks]):
+            start, end = run_start * self.block_len, run_end * self.block_len
+            if self.zi is None:
+                if low_gain_db[run_start] == 0 and high_gain_db[run_start] == 0:
+                    out[..., start:end] = audio[..., start:end]
+                    continue
+                self.zi = np.zeros((2,) + audio.shape[:-1] + (2,))
+            out[..., start:end], self.zi = signal.sosfilt(
+                sos[run_start], audio[..., start:end], axis=-1, zi=self.zi)
+
+        return out
 
 
 class TransitionProfile:
@@ -117,20 +154,18 @@ class TransitionProfile:
         self.low_profile = low_profile
         self.high_profile = high_profile
 
-    def apply(self, audio):
+    def volume_curve(self, num_samples):
+        return profile_curve(self.volume_profile, self.len_dbeats, num_samples)
 
-        output_audio = np.copy(audio)
-        fade_in_len = self.len_dbeats
-
-        low_profile = self.low_profile
-        output_audio = piecewise_lin_fade_filter(output_audio, 'low_shelf', low_profile, fade_in_len)
-
-        high_profile = self.high_profile
-        output_audio = piecewise_lin_fade_filter(output_audio, 'high_shelf', high_profile, fade_in_len)
-
-        volume_profile = self.volume_profile
-        output_audio = piecewise_fade_volume(output_audio, volume_profile, fade_in_len)
+    def apply_eq(self, audio, out=None):
+        num_samples = audio.shape[-1]
+        low_gain_db = profile_to_gain_db(profile_at_blocks(self.low_profile, self.len_dbeats, num_samples))
+        high_gain_db = profile_to_gain_db(profile_at_blocks(self.high_profile, self.len_dbeats, num_samples))
+        return ShelfEQ().process(audio, low_gain_db, high_gain_db, out=out)
 
+    def apply(self, audio, out=None):
+        output_audio = self.apply_eq(audio, out=out)
+        output_audio *= np.sqrt(self.volume_curve(audio.shape[-1]))
         return output_audio
 
 
@@ -182,39 +217,40 @@ class CrossFade:
         self.master_profile = master_profile
         self.slave_profile = slave_profile
 
-    def apply(self, master_audio, new_audio, tempo):
+    def apply(self, master_audio, new_audio, tempo, out=None):
+        """
+        Mixes the start of new_audio into the fade-out of master_audio. Both have shape (..., num_samples), e.g.
+        (channels, num_samples). The result has the shape of new_audio and is written into out, which may be
+        new_audio itself to mix in place. master_audio is not modified.
+        """
         if self.master_profile is None or self.slave_profile is None:
             raise Exception('Master and slave profile must be set. Call optimize(...) before applying!')
 
-        output_audio = master_audio
         fade_len = self.slave_profile.len_dbeats
         fade_len_samples = int(fade_len * (60.0 / tempo) * 4 * 44100)
 
-        master_audio_fadeout = master_audio[:fade_len_samples]
-        output_audio[:fade_len_samples] = self.master_profile.apply(master_audio_fadeout)
-        output_audio[fade_len_samples:] = 0
-
-        new_audio_fadein = new_audio[:fade_len_samples]
-        new_audio_rest = new_audio[fade_len_samples:]
-        new_audio_fadein = self.slave_profile.apply(new_audio_fadein)
-        output_audio[:fade_len_samples] = output_audio[:fade_len_samples] + new_audio_fadein
-
-        output_audio = output_audio[:fade_len_samples]
-        output_audio = np.append(output_audio, new_audio_rest)
-
-        loudness_balance_profile = np.zeros(fade_len_samples)
-        for j in range(len(self.master_profile.volume_profile) - 1):
-            start_dbeat, start_volume_master = self.master_profile.volume_profile[j]
-            end_dbeat, end_volume_master = self.master_profile.volume_profile[j + 1]
-            start_volume_slave = self.slave_profile.volume_profile[j][1]
-            end_volume_slave = self.slave_profile.volume_profile[j + 1][1]
-            start_idx = int(fade_len_samples * float(start_dbeat) / fade_len)
-            end_idx = int(fade_len_samples * float(end_dbeat) / fade_len)
-            master_vol_profile = linear_fade_volume(np.ones(end_idx - start_idx), start_volume_master,
-                                                    end_volume_master)
-            slave_vol_profile = linear_fade_volume(np.ones(end_idx - start_idx), start_volume_slave, end_volume_slave)
-            loudness_balance_profile[start_idx:end_idx] = np.sqrt(
-                1.0 / (master_vol_profile ** 2 + slave_vol_profile ** 2))
-        output_audio[:fade_len_samples] *= loudness_balance_profile
-
-        return output_audio
+        if out is None:
+            out = np.empty(new_audio.shape, dtype='float32')
+        if out is not new_audio:
+            out[..., fade_len_samples:] = new_audio[..., fade_len_samples:]
+
+        # Loudness balance: the volume curves are squared amplitudes, normalise their sum to unity
+        master_gain = self.master_profile.volume_curve(fade_len_samples)
+        slave_gain = self.slave_profile.volume_curve(fade_len_samples)
+        balance = master_gain + slave_gain
+        np.sqrt(balance, out=balance)
+        np.reciprocal(balance, out=balance)
+        np.sqrt(master_gain, out=master_gain)
+        master_gain *= balance
+        np.sqrt(slave_gain, out=slave_gain)
+        slave_gain *= balance
+
+        # The fade-in is computed before writing to out, as out may share memory with new_audio
+        new_audio_fadein = self.slave_profile.apply_eq(new_audio[..., :fade_len_samples])
+        new_audio_fadein *= slave_gain
+        output_fade = out[..., :fade_len_samples]
+        self.master_profile.apply_eq(master_audio[..., :fade_len_samples], out=output_fade)
+        output_fade *= master_gain
+        output_fade += new_audio_fadein
+
+        return out
@@ -1,8 +1,15 @@
+import itertools
+from fractions import Fraction
+
 import librosa.core as core
 import librosa.decompose as decompose
 import librosa.util
 import numpy as np
-from scipy import signal, interpolate
+from scipy import fft, signal
+
+WSOLA_BLOCK_FRAMES = 64
+RESAMPLE_BLOCK_LEN = 44100 * 10
+PITCH_SHIFT_MAX_DENOMINATOR = 100
 
 
 def crossfade(audio1, audio2, length=None):
@@ -30,7 +37,24 @@ def time_stretch_hpss(audio, f):
     return y_harm + y_perc
 
 
+def _search_window_spectra(audio, win_starts, win_len, nfft):
+    """
+    Real FFTs of the WSOLA search windows starting at the given samples, computed as one batched transform.
+    """
+    idx = np.asarray(win_starts, dtype='int')[:, np.newaxis] + np.arange(win_len)
+    return fft.rfft(audio[idx], n=nfft, axis=-1)
+
+
 def time_stretch_sola(audio, f, wsola=False):
+    """
+    (W)SOLA time stretching of a mono signal.
+
+    In WSOLA mode, the spectra of the search windows only depend on the theoretical input positions, so they are
+    computed in batches of WSOLA_BLOCK_FRAMES frames; only the spectrum of the frame to match has to be computed per
+    output frame. The correlations are computed with the same transform sizes as scipy.signal.fftconvolve, so the
+    chosen overlap positions are identical to a per-frame fftconvolve search up to floating point rounding (which can
+    only matter for lags whose correlation values are tied to within rounding error).
+    """
     if f == 1:
         return audio
 
@@ -40,23 +64,44 @@ def time_stretch_sola(audio, f, wsola=False):
     next_frame_offset_f = frame_len_1 / f
     seek_win_len_half = frame_len_1 / 16
 
-    def find_matching_frame(frame, theor_center):
+    num_samples_out = int(f * audio.size)
+    output = np.zeros(num_samples_out + int(frame_len_1))
+
+    num_frames_out = num_samples_out / frame_len_1
+    out_ptrs = range(0, int(num_frames_out * frame_len_1), int(frame_len_1))
+
+    # The theoretical input positions do not depend on the matches, so all search windows are known in advance
+    theor_centers = [int(in_ptr_th_f) - overlap_len
+                     for in_ptr_th_f in itertools.accumulate([next_frame_offset_f] * len(out_ptrs))]
+    win_len = int(2 * seek_win_len_half + frame_len_1)
+    nfft = fft.next_fast_len(win_len + int(frame_len_1) - 1, True)
+    win_spectra = {}
+
+    def find_matching_frame(frame, frame_idx):
+        theor_center = theor_centers[frame_idx]
         cur_win_min = theor_center - seek_win_len_half
         cur_win_max = theor_center + seek_win_len_half
-        correlation = signal.fftconvolve(
-            audio[int(cur_win_min):int(cur_win_max + len(frame))], frame[::-1], mode='valid')
+        if cur_win_min < 0 or len(frame) != frame_len_1 or int(cur_win_min) + win_len > audio.size:
+            # Search window does not fit entirely in the input: fall back to a single convolution
+            correlation = signal.fftconvolve(
+                audio[int(cur_win_min):int(cur_win_max + len(frame))], frame[::-1], mode='valid')
+        else:
+            if frame_idx not in win_spectra:
+                win_spectra.clear()
+                block = range(frame_idx, min(frame_idx + WSOLA_BLOCK_FRAMES, len(theor_centers)))
+                block_starts = {i: int(theor_centers[i] - seek_win_len_half) for i in block}
+                block_valid = [i for i in block if 0 <= block_starts[i] <= audio.size - win_len]
+                spectra = _search_window_spectra(audio, [block_starts[i] for i in block_valid], win_len, nfft)
+                win_spectra.update(zip(block_valid, spectra))
+            frame_spectrum = fft.rfft(frame[::-1], n=nfft)
+            correlation = fft.irfft(win_spectra[frame_idx] * frame_spectrum, n=nfft)[len(frame) - 1:win_len]
         optimum = np.argmax(correlation[:int(2 * seek_win_len_half)])
 
         return theor_center + (optimum - seek_win_len_half)
 
-    num_samples_out = int(f * audio.size)
-    output = np.zeros(num_samples_out + int(frame_len_1))
-
-    num_frames_out = num_samples_out / frame_len_1
-    in_ptr_th_f = 0.0
     in_ptr = 0
 
-    for out_ptr in range(0, int(num_frames_out * frame_len_1), int(frame_len_1)):
+    for frame_idx, out_ptr in enumerate(out_ptrs):
         frame_to_copy = audio[int(in_ptr): int(in_ptr + frame_len_0)]
         output[out_ptr: out_ptr + len(frame_to_copy)] = frame_to_copy
         if in_ptr + frame_len_1 > audio.size:
@@ -66,9 +111,9 @@ def time_stretch_sola(audio, f, wsola=False):
 
         frame_to_match = audio[int(in_ptr + frame_len_0): int(in_ptr + frame_len_0 + frame_len_1)]
         if wsola:
-            match_ptr = find_matching_frame(frame_to_match, int(in_ptr_th_f + next_frame_offset_f) - overlap_len)
+            match_ptr = find_matching_frame(frame_to_match, frame_idx)
         else:
-            match_ptr = int(in_ptr_th_f + next_frame_offset_f) - overlap_len
+            match_ptr = theor_centers[frame_idx]
 
         frame1_overlap = audio[int(in_ptr + frame_len_0): int(in_ptr + frame_len_1 + 1)]
         frame2_overlap = audio[int(match_ptr): int(match_ptr + overlap_len + 1)]
@@ -77,19 +122,41 @@ def time_stretch_sola(audio, f, wsola=False):
         output[int(out_ptr + frame_len_0): int(out_ptr + frame_len_0 + len(temp))] = temp
 
         in_ptr = match_ptr + overlap_len
-        in_ptr_th_f += next_frame_offset_f
 
     return np.array(output).astype('single')
 
 
+def resample_poly_blocks(audio, up, down, block_len=RESAMPLE_BLOCK_LEN):
+    """
+    Polyphase resampling of a mono signal by a factor up / down, processed in blocks to keep the intermediate arrays
+    small. The blocks overlap by more than the anti-aliasing filter length and start at multiples of down, so the
+    result equals a single scipy.signal.resample_poly call over the whole signal. The input dtype is preserved.
+    """
+    half_len = 10 * max(up, down)  # Half length of the resample_poly filter, at the upsampled rate
+    margin = down * int(np.ceil((half_len / up + 1) / down))
+    block_len = down * max(1, block_len // down)
+    num_samples_out = -(-audio.size * up // down)
+    output = np.empty(num_samples_out, dtype=audio.dtype)
+
+    for start in range(0, audio.size, block_len):
+        block_start, block_end = max(0, start - margin), min(audio.size, start + block_len + margin)
+        resampled = signal.resample_poly(audio[block_start:block_end], up, down)
+        out_start = start * up // down
+        out_end = min(num_samples_out, (start + block_len) * up // down)
+        skip = (start - block_start) * up // down
+        output[out_start:out_end] = resampled[skip:skip + out_end - out_start]
+
+    return output
+
+
 def time_stretch_and_pitch_shift(audio, f, semitones=0):
-    semitone_factor = np.power(2.0, semitones / 12.0)
+    # Rational approximation of the pitch shift factor (off by 0.1 cents for the +-1 semitone shifts of the track
+    # lister, at most 2 cents up to an octave), so that the polyphase resampler can be used. The same ratio is folded
+    # into the stretch factor, so the tempo of the output stays exact.
+    semitone_factor = Fraction(np.power(2.0, semitones / 12.0)).limit_denominator(PITCH_SHIFT_MAX_DENOMINATOR)
 
-    audio = time_stretch_hpss(audio, f * semitone_factor)
+    audio = time_stretch_hpss(audio, f * float(semitone_factor))
 
     if semitones != 0:
-        x = range(audio.size)
-        x_new = np.linspace(0, audio.size - 1, int(audio.size / semitone_factor))
-        f = interpolate.interp1d(x, audio, kind='quadratic')
-        audio = f(x_new)
+        audio = resample_poly_blocks(audio, semitone_factor.denominator, semitone_factor.numerator)
     return audio
@@ -1,7 +1,5 @@
 import random
 
-from scipy.spatial.distance import euclidean as euclidean_distance
-
 from . import songcollection
 from . import songtransitions
 from .song import *
@@ -32,10 +30,16 @@ CURRENT_SONG_WEIGHT = 1 - (THEME_WEIGHT + PREV_SONG_WEIGHT)
 NUM_SONGS_IN_KEY_MINIMUM = 5
 NUM_SONGS_ONSETS = 3
 MAX_SONGS_IN_SAME_KEY = 3
+# Songs considered when the listener skips to a new song
+NUM_SONGS_SKIP = 8
 
 ROLLING_START_OFFSET = LENGTH_ROLLING_IN + LENGTH_ROLLING_OUT
 
 
+def euclidean_distance(u, v):
+    return np.linalg.norm(np.asarray(u) - np.asarray(v))
+
+
 def is_vocal_clash_pred(master, slave):
     master = 2 * master[1:-1] + master[:-2] + master[2:] >= 2
     slave = 2 * slave[1:-1] + slave[:-2] + slave[2:] >= 2
@@ -236,6 +240,15 @@ class TrackLister:
 
         return firstSong
 
+    def update_pool(self, added_songs, removed_songs):
+        """
+        Adds the annotated songs among added_songs to the unplayed songs and drops removed_songs from the pool.
+        """
+        removed_paths = set(s.filepath for s in removed_songs)
+        self.songsUnplayed = [s for s in self.songsUnplayed if s.filepath not in removed_paths]
+        self.songsPlayed = [s for s in self.songsPlayed if s.filepath not in removed_paths]
+        self.songsUnplayed.extend(s for s in added_songs if s.hasAllAnnot())
+
     def chooseNewTheme(self, firstSong):
         songs_distance_to_first_song = []
         songs_themes = []
@@ -366,23 +379,49 @@ class TrackLister:
             best_slave_cue = best_slave_cue_clash
             best_master_cue = best_master_cue_clash
 
-        if (best_song.key, best_song.scale) not in closely_related_keys:
-            shifted_key_up, shifted_scale_up = songcollection.get_key_transposed(best_song.key, best_song.scale, 1)
+        self.setSemitoneOffset(best_song, closely_related_keys)
+        self.markPlayed(best_song, master_song)
+
+        return best_song, best_slave_cue, best_master_cue, best_fade_in_len, self.semitone_offset
+
+    def getSkipSong(self, master_song, master_semitone_offset):
+        """
+        Chooses the song to switch to when the listener skips, without comparing onset curves: the song closest to the
+        theme among NUM_SONGS_SKIP random unplayed songs in a key related to the key master_song is played in. Returns
+        the song, the downbeat of its first drop, where it is entered, and its semitone offset.
+        """
+        key, scale = songcollection.get_key_transposed(master_song.key, master_song.scale, master_semitone_offset)
+        song_options = self.getSongOptionsInKey(key, scale)
+        if len(song_options) > NUM_SONGS_SKIP:
+            song_options = song_options[np.random.choice(len(song_options), NUM_SONGS_SKIP, replace=False)]
+        skip_song = self.filterSongOptionsByThemeDistance(song_options, master_song)[0]
+
+        skip_song.open()
+        cues = getAllSlaveCues(skip_song, TYPE_DOUBLE_DROP)
+        # The slave cues lie one downbeat before the drop
+        cue = cues[0][0] + 1 if len(cues) > 0 else skip_song.segment_indices[0]
+
+        self.setSemitoneOffset(skip_song, songcollection.get_closely_related_keys(key, scale))
+        self.markPlayed(skip_song, master_song)
+        return skip_song, cue, self.semitone_offset
+
+    def setSemitoneOffset(self, next_song, closely_related_keys):
+        if (next_song.key, next_song.scale) not in closely_related_keys:
+            shifted_key_up, shifted_scale_up = songcollection.get_key_transposed(next_song.key, next_song.scale, 1)
             if (shifted_key_up, shifted_scale_up) in closely_related_keys:
                 self.semitone_offset = 1
             else:
                 self.semitone_offset = -1
             logger.debug(
-                'Pitch shifting! {} {} by {} semitones'.format(best_song.key, best_song.scale, self.semitone_offset))
+                'Pitch shifting! {} {} by {} semitones'.format(next_song.key, next_song.scale, self.semitone_offset))
         else:
             self.semitone_offset = 0
 
+    def markPlayed(self, next_song, master_song):
         self.prev_song_theme_descriptor = master_song.song_theme_descriptor
-        self.songsPlayed.append(best_song)
-        self.songsUnplayed.remove(best_song)
+        self.songsPlayed.append(next_song)
+        self.songsUnplayed.remove(next_song)
         if len(self.songsUnplayed) <= NUM_SONGS_IN_KEY_MINIMUM:
             logger.debug('Replenishing song pool')
             self.songsUnplayed.extend(self.songsPlayed)
             self.songsPlayed = []
-
-        return best_song, best_slave_cue, best_master_cue, best_fade_in_len, self.semitone_offset
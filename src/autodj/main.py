@@ -1,7 +1,12 @@
+import logging
+import os
+
 from colorlog import ColoredFormatter
 
+from .dj.annotationqueue import AnnotationQueue
 from .dj.annotators.wrappers import *
 from .dj.controller import DjController
+from .dj.metrics import metrics
 from .dj.songcollection import SongCollection
 from .dj.tracklister import TrackLister
 
@@ -18,23 +23,23 @@ logger.setLevel(LOG_LEVEL)
 logger.addHandler(stream)
 
 if __name__ == '__main__':
-    annotation_modules = [
-        BeatAnnotationWrapper(),
-        OnsetCurveAnnotationWrapper(),
-        DownbeatAnnotationWrapper(),
-        StructuralSegmentationWrapper(),
-        ReplayGainWrapper(),
-        KeyEstimatorWrapper(),
-        ThemeDescriptorWrapper(),
-        SingingVoiceWrapper(),
-    ]
+    annotation_modules = default_annotation_modules()
 
     sc = SongCollection(annotation_modules)
     tl = TrackLister(sc)
     dj = DjController(tl)
 
-    essentia.log.infoActive = False
-    essentia.log.warningActive = False
+    metrics.start_export()
+    dj.profile_control.watch('main')
+    watcher = None
+
+    def on_songs_changed(added_paths, removed_paths):
+        added_paths, removed_paths = set(added_paths), set(removed_paths)
+        added_songs = [s for s in sc.songs if s.filepath in added_paths]
+        dj.notify_songs_changed(added_paths, removed_paths)
+        num_unannotated = len([s for s in added_songs if not s.hasAllAnnot()])
+        if num_unannotated:
+            logger.info('{} new songs have to be annotated, use the annotate command'.format(num_unannotated))
 
     while True:
         try:
@@ -52,6 +57,29 @@ if __name__ == '__main__':
                 continue
             sc.load_directory(cmd_split[1])
             logger.info(str(len(sc.songs)) + ' songs loaded [annotated: ' + str(len(sc.get_annotated())) + ']')
+        elif cmd == 'rescan':
+            if len(sc.directories) == 0:
+                logger.warning('Use the loaddir command to load some songs before rescanning!')
+                continue
+            added_paths, removed_paths = sc.rescan()
+            if added_paths or removed_paths:
+                on_songs_changed(added_paths, removed_paths)
+            else:
+                logger.info('No changes found')
+        elif cmd == 'watch':
+            if watcher is not None:
+                watcher.set()
+                watcher = None
+            if len(cmd_split) > 1 and cmd_split[1] == 'off':
+                logger.info('Stopped watching the loaded directories')
+                continue
+            try:
+                interval = float(cmd_split[1])
+            except (IndexError, ValueError):
+                logger.warning('Usage: watch <interval in seconds> | watch off')
+                continue
+            watcher = sc.watch(interval, on_songs_changed)
+            logger.info('Rescanning the loaded directories every {:g} s'.format(interval))
         elif cmd == 'play':
             if len(sc.get_annotated()) == 0:
                 logger.warning('Use the loaddir command to load some songs before playing!')
@@ -80,6 +108,12 @@ if __name__ == '__main__':
                 dj.skipToNextSegment()
             except Exception as e:
                 logger.error(e)
+        elif cmd == 'next':
+            logger.info('Skipping to the next song...')
+            try:
+                dj.skipToNextSong()
+            except Exception as e:
+                logger.error(e)
         elif cmd == 'stop':
             logger.info('Stopping playback!')
             dj.stop()
@@ -88,9 +122,15 @@ if __name__ == '__main__':
         elif cmd == 'showannotated':
             logger.info('Number of annotated songs ' + str(len(sc.get_annotated())))
             logger.info('Number of unannotated songs ' + str(len(sc.get_unannotated())))
+        elif cmd == 'annotate' and len(cmd_split) > 1 and cmd_split[1] == 'daemon':
+            num_submitted = AnnotationQueue().submit([s.filepath for s in sc.get_unannotated()])
+            logger.info('Submitted {} songs to the annotation daemon. Use rescan or watch to load them when they are '
+                        'annotated.'.format(num_submitted))
         elif cmd == 'annotate':
             logger.info('Started annotating!')
-            sc.annotate()
+            annotated_paths = [s.filepath for s in sc.annotate()]
+            # Reloaded by the DJ process and the track lister with their annotations
+            on_songs_changed(annotated_paths, annotated_paths)
             logger.info('Done annotating!')
         elif cmd == 'debug':
             LOG_LEVEL = logging.DEBUG
@@ -100,6 +140,23 @@ if __name__ == '__main__':
             logger.debug('Enabled debug info. Use this command before playing, or it will have no effect.')
         elif cmd == 'mark':
             dj.markCurrentMaster()
+        elif cmd == 'profile':
+            try:
+                if len(cmd_split) > 1 and cmd_split[1] == 'start':
+                    trace_allocations = len(cmd_split) > 2 and cmd_split[2] == 'alloc'
+                    dj.profile_control.start(trace_allocations=trace_allocations)
+                    logger.info('Started profiling' + (' with allocation tracking!' if trace_allocations else '!'))
+                elif len(cmd_split) > 1 and cmd_split[1] == 'stop':
+                    path_pattern = dj.profile_control.stop()
+                    logger.info('Stopped profiling, profiles are written to ' + path_pattern + '.folded')
+                else:
+                    logger.warning('Usage: profile start [alloc] | profile stop')
+            except Exception as e:
+                logger.error(e)
+        elif cmd == 'stats':
+            logger.info(metrics.report())
+        elif cmd == 'buffer':
+            logger.info(dj.telemetry.report())
         elif cmd == 'stereo':
             dj.stereo = not dj.stereo
             logger.info(f'Stereo audio is {"enabled" if dj.stereo else "disabled"}.')
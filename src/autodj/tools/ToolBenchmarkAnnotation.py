@@ -0,0 +1,217 @@
+"""
+Benchmark of the annotation modules on deterministic synthetic tracks.
+
+Each track is a click track at a known tempo over a pad in a known key, with sections of 16 downbeats that alternate
+between low and high energy. The annotation modules are run in the same order as in Song.annotate, and for each of
+them the time per minute of audio and the peak memory are recorded. Results are written as JSON, and can be compared
+with the results of an earlier run:
+
+    python3 -m autodj.tools.ToolBenchmarkAnnotation --lengths 1 3 6 --output bench.json --compare old_bench.json
+
+With --profile fast, the modules are run as in the fast annotation profile.
+"""
+import argparse
+import datetime
+import json
+import platform
+import resource
+import time
+import tracemalloc
+
+import essentia
+import numpy as np
+
+from ..dj.annotators import wrappers
+from ..dj.timestretching import resample_poly_blocks
+
+SAMPLE_RATE = 44100
+KEYS = ['C', 'C#', 'D', 'Eb', 'E', 'F', 'F#', 'G', 'Ab', 'A', 'Bb', 'B']
+DOWNBEATS_PER_SECTION = 16
+
+
+def synthetic_track(length_seconds, bpm=174.0, key='A', scale='minor', seed=0):
+    """
+    Mono float32 track with a kick on every beat (accented on the downbeats), a triad pad in the given key and
+    sections of DOWNBEATS_PER_SECTION downbeats alternating between low and high energy. The high energy sections add
+    a bass line and off-beat hi-hats.
+    """
+    rng = np.random.default_rng(seed)
+    num_samples = int(length_seconds * SAMPLE_RATE)
+    t = np.arange(num_samples) / SAMPLE_RATE
+    spb = 60.0 / bpm
+    high_energy = (np.floor(t / (4 * spb * DOWNBEATS_PER_SECTION)) % 2) == 1
+
+    root = 220.0 * 2 ** ((KEYS.index(key) - KEYS.index('A')) / 12)
+    third = 4 if scale == 'major' else 3
+    audio = np.zeros(num_samples)
+    for interval in (0, third, 7):
+        for octave in (1, 2):
+            audio += 0.04 * np.sin(2 * np.pi * root * octave * 2 ** (interval / 12) * t)
+    audio += np.where(high_energy, 0.15, 0.0) * np.sin(2 * np.pi * root / 4 * t)
+
+    kick_t = np.arange(int(0.08 * SAMPLE_RATE)) / SAMPLE_RATE
+    kick = np.sin(2 * np.pi * (50 + 100 * np.exp(-kick_t * 40)) * kick_t) * np.exp(-kick_t * 30)
+    hat = rng.standard_normal(int(0.03 * SAMPLE_RATE)) * np.exp(-np.arange(int(0.03 * SAMPLE_RATE)) / 200)
+    hat = np.diff(hat, prepend=0)  # Crude high-pass
+
+    for beat_idx, beat in enumerate(np.arange(0, length_seconds, spb)):
+        start = int(beat * SAMPLE_RATE)
+        end = min(num_samples, start + len(kick))
+        audio[start:end] += (1.0 if beat_idx % 4 == 0 else 0.6) * kick[:end - start]
+        offbeat = int((beat + spb / 2) * SAMPLE_RATE)
+        if offbeat < num_samples and high_energy[offbeat]:
+            end = min(num_samples, offbeat + len(hat))
+            audio[offbeat:end] += 0.2 * hat[:end - offbeat]
+
+    audio /= np.max(np.abs(audio))
+    return (0.9 * audio).astype('single')
+
+
+class SyntheticSong:
+    """
+    Stand-in for Song that only holds the audio and the annotations, so the wrappers can be run without any files.
+    """
+
+    def __init__(self, audio):
+        self.audio = audio
+        self.songBeginPadding = 0
+        self.odfs_1024_512 = None
+        self._audio_decimated = {}
+
+    def decimated_audio(self, factor):
+        if factor not in self._audio_decimated:
+            self._audio_decimated[factor] = resample_poly_blocks(self.audio, 1, factor)
+        return self._audio_decimated[factor]
+
+    def add_features(self, features):
+        for k, v in features.items():
+            setattr(self, k, v)
+
+
+# In the order of main.py, since later modules use the annotations of earlier ones
+STAGES = [
+    ('BeatTracker', wrappers.BeatAnnotationWrapper),
+    ('OnsetCurve', wrappers.OnsetCurveAnnotationWrapper),
+    ('DownbeatTracker', wrappers.DownbeatAnnotationWrapper),
+    ('StructuralSegmentator', wrappers.StructuralSegmentationWrapper),
+    ('ReplayGain', wrappers.ReplayGainWrapper),
+    ('KeyEstimator', wrappers.KeyEstimatorWrapper),
+    ('ThemeDescriptorEstimator', wrappers.ThemeDescriptorWrapper),
+    ('SingingVoiceDetector', wrappers.SingingVoiceWrapper),
+]
+
+
+def max_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def load_annotators(wrapper):
+    """
+    Creates the annotators of a wrapper, which are otherwise only created when it first annotates a song.
+    """
+    for cls in type(wrapper).__mro__:
+        for attr, value in vars(cls).items():
+            if isinstance(value, wrappers.LazyAnnotator):
+                getattr(wrapper, attr)
+
+
+def benchmark_track(modules, audio):
+    """
+    Runs all annotation modules on audio and returns the song with its annotations and the measurements per stage.
+    Peak memory is measured with tracemalloc, which sees NumPy allocations but not those inside Essentia, so the
+    maximum resident set size of the process is recorded as well.
+    """
+    song = SyntheticSong(audio)
+    minutes = len(audio) / SAMPLE_RATE / 60
+    stages = {}
+    for name, module in modules:
+        tracemalloc.start()
+        start = time.perf_counter()
+        song.add_features(module.process(song))
+        song.add_features(module.calculate_supplimentary_features(song))
+        seconds = time.perf_counter() - start
+        _, peak_bytes = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        stages[name] = {
+            'seconds': seconds,
+            'seconds_per_minute': seconds / minutes,
+            'peak_traced_mb': peak_bytes / 1024 ** 2,
+            'max_rss_mb': max_rss_mb(),
+        }
+    return song, stages
+
+
+def compare(results, previous):
+    print('{:28s} {:>8s} {:>12s} {:>12s} {:>8s}'.format('stage', 'minutes', 'previous', 'current', 'ratio'))
+    previous_tracks = {(t['length_minutes'], t['bpm'], t['key'], t['scale']): t for t in previous['tracks']}
+    for track in results['tracks']:
+        other = previous_tracks.get((track['length_minutes'], track['bpm'], track['key'], track['scale']))
+        if other is None:
+            continue
+        for name, stage in track['stages'].items():
+            if name not in other['stages']:
+                continue
+            old = other['stages'][name]['seconds_per_minute']
+            new = stage['seconds_per_minute']
+            print('{:28s} {:8.1f} {:10.3f}s {:10.3f}s {:7.2f}x'.format(
+                name, track['length_minutes'], old, new, new / old if old > 0 else float('nan')))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the annotation modules on synthetic tracks.')
+    parser.add_argument('--lengths', type=float, nargs='+', default=[1, 3, 6], help='track lengths in minutes')
+    parser.add_argument('--bpm', type=float, default=174.0)
+    parser.add_argument('--key', default='A', choices=KEYS)
+    parser.add_argument('--scale', default='minor', choices=['major', 'minor'])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--profile', default='full', choices=wrappers.ANNOTATION_PROFILES, help='annotation profile')
+    parser.add_argument('--output', default='annotation_benchmark.json')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare with')
+    args = parser.parse_args()
+
+    essentia.log.infoActive = False
+    essentia.log.warningActive = False
+
+    decimation = wrappers.FAST_PROFILE_DECIMATION if args.profile == 'fast' else 1
+    modules = [(name, wrapper(decimation) if issubclass(wrapper, wrappers.DecimatedAnnotationWrapper) else wrapper())
+               for name, wrapper in STAGES]
+    # The annotators are created and their models loaded before the measurements, which would otherwise include them
+    # in the first track
+    for name, wrapper in modules:
+        load_annotators(wrapper)
+
+    results = {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'essentia': essentia.__version__,
+        'profile': args.profile,
+        'tracks': [],
+    }
+    for length in args.lengths:
+        audio = synthetic_track(length * 60, args.bpm, args.key, args.scale, args.seed)
+        song, stages = benchmark_track(modules, audio)
+        results['tracks'].append({
+            'length_minutes': length,
+            'bpm': args.bpm,
+            'key': args.key,
+            'scale': args.scale,
+            'detected': {'tempo': float(song.tempo), 'key': song.key, 'scale': song.scale},
+            'stages': stages,
+        })
+        print('{:.1f} min: {}'.format(length, ', '.join(
+            '{} {:.2f}s/min'.format(name, stage['seconds_per_minute']) for name, stage in stages.items())))
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('Results written to ' + args.output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
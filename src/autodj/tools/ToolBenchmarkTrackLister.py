@@ -0,0 +1,168 @@
+"""
+Benchmark of next-song selection in TrackLister on synthetic song collections of increasing size.
+
+The collections hold annotated songs without any audio: random keys, theme descriptors, singing voice annotations
+and segment annotations alternating between low and high energy parts. A dry-run mix of a number of transitions is
+selected for each collection size, and the latency per transition and the memory use are reported:
+
+    python3 -m autodj.tools.ToolBenchmarkTrackLister --sizes 100 1000 10000 100000 --transitions 20
+
+Songs are kept in memory, so the time Song.open() would spend loading the annotations from disk is not included;
+the number of open() calls per transition is reported instead. To keep large collections in memory, the onset
+curves are drawn from a pool of --onset-pool distinct curves shared between songs.
+"""
+import argparse
+import datetime
+import json
+import platform
+import random
+import resource
+import time
+import tracemalloc
+
+import numpy as np
+
+from ..dj import tracklister
+from ..dj.song import Song
+from ..dj.songcollection import SongCollection, notes
+from ..dj.tracklister import TrackLister
+
+SAMPLE_RATE = 44100
+HOP_SIZE = 512
+TEMPO = 175
+THEME_DESCRIPTOR_DIMS = 3
+DOWNBEATS_PER_SEGMENT = 16
+
+
+class SyntheticSong(Song):
+    """
+    Annotated song that only exists in memory. open() and close() are no-ops that count how often they are called.
+    """
+    num_opens = 0
+
+    def __init__(self, title, rng, onset_curves):
+        self.title = title
+        self.annotation_modules = []
+        self.audio_stereo = None
+        self.audio = None
+        self.songBeginPadding = 0
+
+        length_s = rng.uniform(4, 7) * 60
+        spb = 60 / TEMPO
+        self.tempo = TEMPO
+        self.key = notes[rng.integers(len(notes))]
+        self.scale = 'major' if rng.random() < 0.5 else 'minor'
+        self.beats = np.arange(0, length_s, spb)
+        self.downbeats = self.beats[::4]
+        num_segments = len(self.downbeats) // DOWNBEATS_PER_SEGMENT
+        self.segment_indices = [i * DOWNBEATS_PER_SEGMENT for i in range(num_segments)]
+        self.segment_types = ['L' if i % 2 == 0 else 'H' for i in range(num_segments)]
+        self.singing_voice = (rng.random(len(self.downbeats)) < 0.2).astype('single')
+        self.song_theme_descriptor = rng.standard_normal(THEME_DESCRIPTOR_DIMS).astype('single')
+        self.onset_curve = onset_curves[rng.integers(len(onset_curves))]
+
+    def open(self):
+        SyntheticSong.num_opens += 1
+
+    def close(self):
+        pass
+
+
+def synthetic_collection(num_songs, rng, onset_pool):
+    max_frames = int(7 * 60 * SAMPLE_RATE / HOP_SIZE) + 1
+    onset_curves = [rng.random(max_frames).astype('single') for _ in range(onset_pool)]
+    sc = SongCollection([])
+    sc.songs = [SyntheticSong('song_{:06d}'.format(i), rng, onset_curves) for i in range(num_songs)]
+    sc.init_key_title_map()
+    return sc
+
+
+def dry_run(tl, num_transitions):
+    """
+    Selects num_transitions transitions the way DjController does, without rendering any audio. Returns the latency
+    and the number of Song.open() calls of each transition.
+    """
+    current_song = tl.getFirstSong()
+    cue_master_in = current_song.segment_indices[0]
+    fade_in_len = 16
+    fade_type = tracklister.TYPE_CHILL
+    latencies, opens = [], []
+    for _ in range(num_transitions):
+        num_opens = SyntheticSong.num_opens
+        start = time.perf_counter()
+        cue_master_out, next_fade_type, max_fade_in_len, fade_out_len = tracklister.getMasterQueue(
+            current_song, cue_master_in + fade_in_len, fade_type)
+        next_song, cue_next_in, cue_master_out, fade_in_len, _ = tl.getBestNextSongAndCrossfade(
+            current_song, cue_master_out, max_fade_in_len, fade_out_len, next_fade_type)
+        latencies.append(time.perf_counter() - start)
+        opens.append(SyntheticSong.num_opens - num_opens)
+        current_song, cue_master_in, fade_type = next_song, cue_next_in, next_fade_type
+    return np.array(latencies), np.array(opens)
+
+
+def benchmark_size(num_songs, num_transitions, seed, onset_pool):
+    rng = np.random.default_rng(seed)
+    random.seed(seed)
+    np.random.seed(seed)
+
+    # Memory is traced only while building the collection, since tracing would distort the selection latencies
+    tracemalloc.start()
+    sc = synthetic_collection(num_songs, rng, onset_pool)
+    collection_bytes, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    tl = TrackLister(sc)
+    start = time.perf_counter()
+    latencies, opens = dry_run(tl, num_transitions)
+    total_seconds = time.perf_counter() - start
+
+    return {
+        'num_songs': num_songs,
+        'num_transitions': num_transitions,
+        'total_seconds': total_seconds,
+        'latency_seconds': {
+            'p50': float(np.percentile(latencies, 50)),
+            'p90': float(np.percentile(latencies, 90)),
+            'p99': float(np.percentile(latencies, 99)),
+            'max': float(np.max(latencies)),
+        },
+        'opens_per_transition': float(np.mean(opens)),
+        'collection_mb': collection_bytes / 1024 ** 2,
+        # ru_maxrss is in kilobytes on Linux
+        'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark next-song selection on synthetic song collections.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000, 100000])
+    parser.add_argument('--transitions', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--onset-pool', type=int, default=256, help='number of distinct onset curves')
+    parser.add_argument('--output', default='tracklister_benchmark.json')
+    args = parser.parse_args()
+
+    results = {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'collections': [],
+    }
+    print('{:>8s} {:>9s} {:>9s} {:>9s} {:>9s} {:>8s} {:>10s} {:>9s}'.format(
+        'songs', 'p50', 'p90', 'p99', 'max', 'opens', 'coll. MB', 'RSS MB'))
+    for num_songs in args.sizes:
+        result = benchmark_size(num_songs, args.transitions, args.seed, args.onset_pool)
+        results['collections'].append(result)
+        latency = result['latency_seconds']
+        print('{:8d} {:8.3f}s {:8.3f}s {:8.3f}s {:8.3f}s {:8.0f} {:10.1f} {:9.1f}'.format(
+            num_songs, latency['p50'], latency['p90'], latency['p99'], latency['max'],
+            result['opens_per_transition'], result['collection_mb'], result['max_rss_mb']))
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('Results written to ' + args.output)
+
+
+if __name__ == '__main__':
+    main()
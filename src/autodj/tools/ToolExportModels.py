@@ -0,0 +1,102 @@
+"""
+Exports the pickled scikit-learn models of the annotation modules to plain NumPy files, which are read by
+annotation/npmodels.py. Every fitted attribute (every array, and the kernel and kernel coefficient of an SVM) is
+written to <model>.<attribute>.npy next to the pickle:
+
+    python3 -m autodj.tools.ToolExportModels
+
+The pickles were written by sklearn.externals.joblib, which newer scikit-learn versions no longer provide. They are
+therefore read with a minimal unpickler of the joblib format that does not need scikit-learn at all: the estimator
+objects are restored as plain attribute containers, and the arrays that joblib stores after the pickle opcodes are
+read back directly.
+"""
+import os
+import pickle
+import sys
+
+import numpy as np
+
+ANNOTATION_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'annotation')
+
+MODELS = [
+    ('downbeat', 'model'),
+    ('downbeat', 'scaler'),
+    ('singing', 'singingvoice_model'),
+    ('singing', 'singingvoice_scaler'),
+    ('style', 'song_theme_scaler_2'),
+    ('style', 'song_theme_pca_model_python3'),
+]
+
+SCALAR_ATTRIBUTES = ['_gamma', 'kernel']
+
+
+class FittedAttributes:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+
+class NumpyArrayWrapper(FittedAttributes):
+    pass
+
+
+class JoblibUnpickler(pickle._Unpickler):
+    dispatch = dict(pickle._Unpickler.dispatch)
+
+    def find_class(self, module, name):
+        if module.startswith('sklearn'):
+            if name == 'NumpyArrayWrapper':
+                return NumpyArrayWrapper
+            return type(name, (FittedAttributes,), {})
+        return super().find_class(module, name)
+
+    def load_build(self):
+        super().load_build()
+        wrapper = self.stack[-1]
+        if isinstance(wrapper, NumpyArrayWrapper):
+            # The array data follows the BUILD opcode of its wrapper in the file
+            if wrapper.dtype.hasobject:
+                array = pickle.load(self.file)
+            else:
+                count = int(np.prod(wrapper.shape))
+                array = np.frombuffer(self.read(count * wrapper.dtype.itemsize), dtype=wrapper.dtype)
+                array = array.reshape(wrapper.shape, order=wrapper.order)
+            self.stack[-1] = array
+
+    dispatch[pickle.BUILD[0]] = load_build
+
+
+def load_joblib_pickle(path):
+    with open(path, 'rb') as f:
+        unpickler = JoblibUnpickler(f, encoding='latin1')
+        unpickler.file = f
+        return unpickler.load()
+
+
+def export_model(directory, name):
+    model = load_joblib_pickle(os.path.join(directory, name + '.pkl'))
+    for attribute, value in vars(model).items():
+        if isinstance(value, np.ndarray) or attribute in SCALAR_ATTRIBUTES:
+            np.save(os.path.join(directory, '{}.{}.npy'.format(name, attribute)), np.asarray(value))
+            print('{}/{}.{}: {}'.format(os.path.basename(directory), name, attribute, np.shape(value)))
+    return model
+
+
+def main():
+    num_missing = 0
+    for subdir, name in MODELS:
+        directory = os.path.join(ANNOTATION_DIR, subdir)
+        if not os.path.isfile(os.path.join(directory, name + '.pkl')):
+            print('Skipping {}/{}.pkl, not found'.format(subdir, name))
+            num_missing += 1
+            continue
+        model = export_model(directory, name)
+        if getattr(model, 'whiten', False):
+            print('Warning: {} uses whitening, which annotation/npmodels.py does not implement'.format(name))
+    sys.exit(1 if num_missing else 0)
+
+
+if __name__ == '__main__':
+    main()
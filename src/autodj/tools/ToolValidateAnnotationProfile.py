@@ -0,0 +1,138 @@
+"""
+Validates the 'fast' annotation profile against the full-rate profile on a reference set of annotated songs. The
+modules that analyse the songs at a lower sample rate in the fast profile (key, theme descriptor and singing voice) are
+run on every song with both profiles, and the agreement of their outputs and the time they take are reported:
+
+    python3 -m autodj.tools.ToolValidateAnnotationProfile /home/username/music/reference --output validation.json
+
+The songs must have been annotated before (the beats, downbeats and segments are used as they are), and songs that are
+not are skipped. The exit status is 1 if a module does not meet its threshold.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import essentia
+import numpy as np
+
+from ..dj import song
+from ..dj.annotators import wrappers
+
+
+def run_profile(modules, songs):
+    """
+    Returns the outputs of each module for all songs, and the seconds each module took. Deriving the decimated audio is
+    timed separately, as it is shared by the modules.
+    """
+    outputs, seconds = {}, {}
+    if any(getattr(module, 'decimation', 1) > 1 for module in modules):
+        start = time.perf_counter()
+        for s in songs:
+            s.decimated_audio(wrappers.FAST_PROFILE_DECIMATION)
+        seconds['decimation'] = time.perf_counter() - start
+    for module in modules:
+        start = time.perf_counter()
+        outputs[str(module)] = module.process_batch(songs)
+        seconds[str(module)] = time.perf_counter() - start
+    return outputs, seconds
+
+
+def agreement(module_name, full, fast):
+    """
+    Agreement between the outputs of a module in both profiles, for all songs: the fraction of songs with the same key,
+    the mean distance between the theme descriptors relative to their norm, and the fraction of downbeats with the same
+    singing voice decision.
+    """
+    if module_name == 'KeyEstimatorWrapper':
+        return np.mean([(a['key'], a['scale']) == (b['key'], b['scale']) for a, b in zip(full, fast)])
+    if module_name == 'ThemeDescriptorWrapper':
+        return np.mean([np.linalg.norm(np.subtract(a['song_theme_descriptor'], b['song_theme_descriptor']))
+                        / np.linalg.norm(a['song_theme_descriptor']) for a, b in zip(full, fast)])
+    if module_name == 'SingingVoiceWrapper':
+        return np.mean(np.concatenate([np.array(a['singing_voice']) > 0 for a in full])
+                       == np.concatenate([np.array(b['singing_voice']) > 0 for b in fast]))
+    raise ValueError('No agreement measure for ' + module_name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Validate the fast annotation profile against the full-rate one.')
+    parser.add_argument('directory', help='directory with the annotated reference songs')
+    parser.add_argument('--max-songs', type=int, default=None)
+    parser.add_argument('--output', help='file to write the results to as JSON')
+    parser.add_argument('--min-key-agreement', type=float, default=0.9)
+    parser.add_argument('--max-theme-difference', type=float, default=0.1, help='relative to the descriptor norm')
+    parser.add_argument('--min-singing-agreement', type=float, default=0.9)
+    args = parser.parse_args()
+
+    essentia.log.infoActive = False
+    essentia.log.warningActive = False
+
+    full_modules = wrappers.default_annotation_modules('full')
+    fast_modules = wrappers.default_annotation_modules('fast')
+    compared = [(full, fast) for full, fast in zip(full_modules, fast_modules)
+                if isinstance(full, wrappers.DecimatedAnnotationWrapper)]
+
+    songs = []
+    for filename in sorted(os.listdir(args.directory)):
+        if not (filename.endswith('.wav') or filename.endswith('.mp3')):
+            continue
+        s = song.Song(os.path.join(args.directory, filename), annotation_modules=full_modules)
+        s.open()
+        if not s.hasAllAnnot():
+            print('Skipping {}, not annotated'.format(filename))
+            continue
+        songs.append(s)
+        if args.max_songs is not None and len(songs) >= args.max_songs:
+            break
+    if len(songs) == 0:
+        print('No annotated songs in ' + args.directory)
+        sys.exit(1)
+
+    for s in songs:
+        s.openRawAudio()  # As the songs are annotated, without begin padding and gain normalisation
+
+    full_outputs, full_seconds = run_profile([full for full, _ in compared], songs)
+    fast_outputs, fast_seconds = run_profile([fast for _, fast in compared], songs)
+
+    thresholds = {
+        'KeyEstimatorWrapper': (args.min_key_agreement, np.greater_equal),
+        'ThemeDescriptorWrapper': (args.max_theme_difference, np.less_equal),
+        'SingingVoiceWrapper': (args.min_singing_agreement, np.greater_equal),
+    }
+    results = {'num_songs': len(songs), 'decimation': wrappers.FAST_PROFILE_DECIMATION, 'modules': {}}
+    num_failed = 0
+    print('{:24s} {:>10s} {:>10s} {:>8s} {:>10s} {:>10s}'.format(
+        'module', 'full', 'fast', 'speedup', 'agreement', 'threshold'))
+    for full, _ in compared:
+        name = str(full)
+        value = float(agreement(name, full_outputs[name], fast_outputs[name]))
+        threshold, compare = thresholds[name]
+        passed = bool(compare(value, threshold))
+        num_failed += not passed
+        results['modules'][name] = {
+            'full_seconds': full_seconds[name],
+            'fast_seconds': fast_seconds[name],
+            'agreement': value,
+            'threshold': threshold,
+            'passed': passed,
+        }
+        print('{:24s} {:9.2f}s {:9.2f}s {:7.2f}x {:10.3f} {:10.3f}{}'.format(
+            name, full_seconds[name], fast_seconds[name], full_seconds[name] / max(fast_seconds[name], 1e-9), value,
+            threshold, '' if passed else '  FAILED'))
+    total_full = sum(full_seconds.values())
+    total_fast = sum(fast_seconds.values())
+    results['full_seconds'], results['fast_seconds'] = total_full, total_fast
+    print('Total {:.2f}s full, {:.2f}s fast (including {:.2f}s decimating), {:.2f}x'.format(
+        total_full, total_fast, fast_seconds.get('decimation', 0.0), total_full / max(total_fast, 1e-9)))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print('Results written to ' + args.output)
+    sys.exit(1 if num_failed else 0)
+
+
+if __name__ == '__main__':
+    main()
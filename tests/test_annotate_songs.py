@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('librosa')
+
+from autodj.dj import song
+from autodj.dj.annotators.wrappers import BaseAnnotationWrapper, BeatAnnotationWrapper
+
+
+class StubBeatTracker:
+    """
+    Beat tracker whose onset detection functions are derived from the audio, so every song gets different ones.
+    """
+
+    def run(self, audio):
+        self.bpm = 175.0
+        self.phase = 0.1
+        self.odfs_1024_512 = {'hfc': np.array([audio[0]]), 'melflux': np.array([-audio[0]])}
+
+
+class SpectraRecorder(BaseAnnotationWrapper):
+    """
+    Module after the beat tracker that records the onset detection functions it is given, as the onset curve module
+    uses them.
+    """
+
+    def __init__(self):
+        self.odfs = {}
+
+    def process(self, s):
+        self.odfs[s.title] = s.odfs_1024_512
+        return {'recorded': True}
+
+    def is_annotated_in(self, s):
+        return hasattr(s, 'recorded')
+
+
+def test_batch_keeps_onset_detection_functions_per_song(tmp_path, monkeypatch):
+    levels = {'first': 0.25, 'second': 0.75}
+    monkeypatch.setattr(song.Song, '_loadPcm',
+                        lambda self, *args: np.full((2, 44100), levels[self.title], dtype='single'))
+    beat_wrapper = BeatAnnotationWrapper()
+    beat_wrapper.__dict__['beattracker'] = StubBeatTracker()
+    recorder = SpectraRecorder()
+    songs = []
+    for title in levels:
+        (tmp_path / (title + '.wav')).touch()
+        songs.append(song.Song(str(tmp_path / (title + '.wav')), annotation_modules=[beat_wrapper, recorder]))
+
+    song.annotate_songs(songs)
+
+    for title, level in levels.items():
+        odfs = recorder.odfs[title]
+        assert np.allclose(odfs['hfc'], [level]) and np.allclose(odfs['melflux'], [-level])